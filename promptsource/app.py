@@ -17,7 +17,15 @@ from pygments.lexers import DjangoLexer
 
 from promptsource import DEFAULT_PROMPTSOURCE_CACHE_HOME
 from promptsource.session import _get_state
-from promptsource.templates import INCLUDED_USERS, LANGUAGES, METRICS, DatasetTemplates, Template, TemplateCollection
+from promptsource.templates import (
+    INCLUDED_USERS,
+    LANGUAGES,
+    METRICS,
+    DatasetTemplates,
+    Template,
+    TemplateCollection,
+    TemplatesFileConflictError,
+)
 from promptsource.utils import (
     get_dataset,
     get_dataset_confs,
@@ -164,6 +172,7 @@ def run_app():
         #
         try:
             template_collection = TemplateCollection()
+            template_collection.load_all()
         except FileNotFoundError:
             st.error(
                 "Unable to find the prompt folder!\n\n"
@@ -512,9 +521,12 @@ def run_app():
                             st.error("Need to provide a prompt name.")
                         else:
                             template = Template(new_template_name, "", "")
-                            dataset_templates.add_template(template)
-                            reset_template_state()
-                            state.template_name = new_template_name
+                            try:
+                                dataset_templates.add_template(template)
+                                reset_template_state()
+                                state.template_name = new_template_name
+                            except TemplatesFileConflictError as e:
+                                st.error(str(e))
                     else:
                         state.new_template_name = None
 
@@ -529,8 +541,11 @@ def run_app():
                     )
 
                     if st.button("Delete Prompt", key="delete_prompt"):
-                        dataset_templates.remove_template(state.template_name)
-                        reset_template_state()
+                        try:
+                            dataset_templates.remove_template(state.template_name)
+                            reset_template_state()
+                        except TemplatesFileConflictError as e:
+                            st.error(str(e))
 
                 variety_guideline = """
                 :heavy_exclamation_mark::question:Creating a diverse set of prompts whose differences go beyond surface wordings (i.e. marginally changing 2 or 3 words) is highly encouraged.
@@ -629,16 +644,19 @@ def run_app():
                                     else:
                                         updated_answer_choices = state.answer_choices
 
-                                    dataset_templates.update_template(
-                                        state.template_name,
-                                        updated_template_name,
-                                        state.jinja,
-                                        state.reference,
-                                        state.metadata,
-                                        updated_answer_choices,
-                                    )
-                                    # Update the state as well
-                                    state.template_name = updated_template_name
+                                    try:
+                                        dataset_templates.update_template(
+                                            state.template_name,
+                                            updated_template_name,
+                                            state.jinja,
+                                            state.reference,
+                                            state.metadata,
+                                            updated_answer_choices,
+                                        )
+                                        # Update the state as well
+                                        state.template_name = updated_template_name
+                                    except TemplatesFileConflictError as e:
+                                        st.error(str(e))
                 #
                 # Displays template output on current example if a template is selected
                 # (in second column)
@@ -1,21 +1,68 @@
+import concurrent.futures
+import contextlib
+import functools
+import hashlib
+import json
 import logging
+import mmap
 import os
+import pickle
 import random
+import re
+import threading
+import time
 import uuid
-from collections import Counter, defaultdict
+from collections import Counter, OrderedDict, defaultdict
 from shutil import rmtree
-from typing import Dict, List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
-import pandas as pd
+import jinja2
 import pkg_resources
+import pyarrow as pa
+import pyarrow.parquet as pq
 import yaml
-from jinja2 import BaseLoader, Environment, meta
+from jinja2 import BaseLoader, Environment, FileSystemBytecodeCache, meta, nodes, pass_context
+from jinja2.visitor import NodeTransformer
+
+from promptsource import DEFAULT_PROMPTSOURCE_CACHE_HOME
+
+
+try:
+    import fcntl
+except ImportError:
+    # Advisory locks are not available on Windows, where writes are only atomic
+    fcntl = None
 
 
 # Truncation of jinja template variables
 # 1710 = 300 words x 4.7 avg characters per word + 300 spaces
 TEXT_VAR_LENGTH = 2048
 
+# Output of a template that is only the answer choice indexed by an example field, possibly within control
+# statements, e.g. "{% if label != -1 %}{{ answer_choices[label] }}{% endif %}"
+LABEL_INDEXED_OUTPUT = re.compile(
+    r"^\s*(?:{%.*?%}\s*)*{{\s*answer_choices\s*\[\s*([A-Za-z_][A-Za-z0-9_]*)\s*\]\s*}}\s*(?:{%.*?%}\s*)*$", re.DOTALL
+)
+
+# Name of the rendering context variable holding the random number generator used by the choice filter
+RNG_CONTEXT_KEY = "_promptsource_rng"
+
+# libyaml's C loader is much faster than the pure Python one, but is only available if PyYAML was built with it
+YAML_LOADER = getattr(yaml, "CFullLoader", yaml.FullLoader)
+# Same for the dumper, whose output is equivalent but folds long strings differently, see TemplateCollection.batch
+YAML_C_DUMPER = getattr(yaml, "CDumper", yaml.Dumper)
+
+# Tag of each template in a templates.yaml file, used to count templates without parsing the file
+TEMPLATE_TAG_PATTERN = re.compile(rb": !Template$", re.MULTILINE)
+
+# Maximum number of compiled Jinja templates kept in memory
+COMPILED_TEMPLATE_CACHE_SIZE = 4096
+
+# Default folder of the persistent cache of compiled templates. The cache is opt-in: it is enabled by
+# enable_bytecode_cache, or in every process by setting the PROMPTSOURCE_BYTECODE_CACHE environment variable
+# to 1 (for this folder) or to another folder.
+BYTECODE_CACHE_DIR = os.path.join(DEFAULT_PROMPTSOURCE_CACHE_HOME, "bytecode")
+
 # Local path to the folder containing the templates
 TEMPLATES_FOLDER_PATH = pkg_resources.resource_filename(__name__, "templates")
 
@@ -239,8 +286,28 @@ def highlight(input):
     return "<span style='color: #F08080'>" + input + "</span>"
 
 
-def choice(choices):
-    return random.choice(choices)
+@pass_context
+def choice(context, choices):
+    # Draws from the random number generator passed to Template.apply, if any, and from the global one otherwise.
+    # Depending on the context also keeps Jinja from folding constant choices at compile time, which would freeze
+    # the choice in the cached compiled template.
+    rng = context.get(RNG_CONTEXT_KEY) or random
+    return rng.choice(choices)
+
+
+def get_example_rng(seed, template_id, split=None, index=None) -> random.Random:
+    """
+    Returns a random number generator for one example, derived from a seed and the position of the example. The
+    stream only depends on its arguments, so sharded or distributed runs are reproducible without coordination.
+
+    :param seed: global seed of the run
+    :param template_id: id of the template applied to the example
+    :param split: split of the example
+    :param index: index of the example in its split
+    :return: a random.Random
+    """
+    key = f"{seed}/{template_id}/{split}/{index}".encode("utf-8")
+    return random.Random(int.from_bytes(hashlib.sha256(key).digest()[:8], "big"))
 
 
 def most_frequent(items):
@@ -252,6 +319,7 @@ def most_frequent(items):
     most_frequent_items = [c[0] for c in item_counts if c[1] == max_freq]
     return most_frequent_items
 
+
 def has_none_or_empty_raise(values):
     none_found = False
     if isinstance(values, list):
@@ -265,11 +333,387 @@ def has_none_or_empty_raise(values):
     return values  # This line will only be reached if no empty or None values are found.
 
 
+def split_answer_choices(rendered_choices, delimeter):
+    """Splits rendered answer choices into the list exposed to templates as `answer_choices`"""
+    return [
+        Template._unescape_pipe(answer_choice.strip(), delimeter)
+        for answer_choice in rendered_choices.split(delimeter)
+    ]
+
+
 env.filters["highlight"] = highlight
 env.filters["choice"] = choice
 env.filters["most_frequent"] = most_frequent
 env.filters["no_none"] = has_none_or_empty_raise
+env.filters["split_answer_choices"] = split_answer_choices
+
+
+class OutputFilterInjector(NodeTransformer):
+    """
+    Wraps the expression of every `{{ ... }}` output of a parsed template in a chain of filters.
+
+    The filters are given as (name, args) pairs and applied in order, so [("string", ()), ("truncate", (10,))] turns
+    `{{ text }}` into `{{ (text) | string | truncate(10) }}`.
+    """
+
+    def __init__(self, output_filters):
+        self.output_filters = output_filters
+
+    def visit_Output(self, node):
+        node.nodes = [child if isinstance(child, nodes.TemplateData) else self.wrap(child) for child in node.nodes]
+        return node
+
+    def wrap(self, expr):
+        for name, args in self.output_filters:
+            expr = nodes.Filter(expr, name, [nodes.Const(arg) for arg in args], [], None, None, lineno=expr.lineno)
+        return expr
+
+
+def compile_template(source, delimeter="|||", output_filters=(), answer_choices=None):
+    """
+    Compiles a Jinja template, optionally with filters applied to its outputs and with answer choices rendered along
+
+    :param source: Jinja source of the template
+    :param delimeter: separator between prompt and output, and between answer choices
+    :param output_filters: (name, args) pairs of filters to apply to every `{{ ... }}` output of the source
+    :param answer_choices: if not None, Jinja expression of answer choices rendered before the source and exposed to
+                           it as the list `answer_choices`
+    :return: a jinja2.Template
+    """
+    if env.bytecode_cache is None:
+        code = _compile_code(source, delimeter, output_filters, answer_choices)
+    else:
+        # The persistent cache is keyed by everything the generated code depends on, including the Jinja version
+        cache_key = repr((jinja2.__version__, source, delimeter, output_filters, answer_choices))
+        bucket = env.bytecode_cache.get_bucket(env, cache_key, None, cache_key)
+        if bucket.code is None:
+            bucket.code = _compile_code(source, delimeter, output_filters, answer_choices)
+            env.bytecode_cache.set_bucket(bucket)
+        code = bucket.code
+    return env.template_class.from_code(env, code, env.make_globals(None))
+
+
+def _compile_code(source, delimeter, output_filters, answer_choices):
+    ast = env.parse(source)
+    if output_filters:
+        ast = OutputFilterInjector(output_filters).visit(ast)
+    if answer_choices is not None:
+        # The answer choices are not affected by the output filters
+        prelude = env.parse(
+            "{% set answer_choices %}{% endset %}"
+            f"{{% set answer_choices = answer_choices | split_answer_choices({delimeter!r}) %}}"
+        )
+        prelude.body[0].body = env.parse(answer_choices).body
+        ast.body = prelude.body + ast.body
+    ast.set_environment(env)
+    return env.compile(ast)
+
+
+def enable_bytecode_cache(directory: Optional[str] = None) -> None:
+    """
+    Persists the compiled templates on disk, so that other processes do not have to compile them again
+
+    :param directory: folder of the cache, defaults to BYTECODE_CACHE_DIR
+    """
+    directory = directory or BYTECODE_CACHE_DIR
+    os.makedirs(directory, exist_ok=True)
+    env.bytecode_cache = FileSystemBytecodeCache(directory)
+
+
+def disable_bytecode_cache() -> None:
+    """
+    Stops persisting the compiled templates on disk
+    """
+    env.bytecode_cache = None
+
+
+def precompile_templates(templates, option_sets=((False, False, True),)) -> int:
+    """
+    Compiles templates ahead of time, e.g., to fill the persistent cache before a large job
+
+    :param templates: iterable of Template objects
+    :param option_sets: (truncate, highlight_variables, no_none) tuples to compile each template for
+    :return: number of templates compiled
+    """
+    count = 0
+    for template in templates:
+        for truncate, highlight_variables, no_none in option_sets:
+            template._compile_prompt(truncate, highlight_variables, no_none)
+        if template.answer_choices is not None:
+            template._compile(template.answer_choices)
+        count += 1
+    return count
+
+
+def count_whitespace_tokens(text: str) -> int:
+    """Length function counting whitespace-separated tokens"""
+    return len(text.split())
+
+
+class TruncationBudget:
+    """
+    Total length budget shared by the fields of an example, to pass as the `truncate` argument of Template.apply.
+
+    Lengths are measured with a pluggable length function, e.g. count_whitespace_tokens or
+    `lambda text: len(tokenizer(text).input_ids)`, and measurements are cached. Fields only referenced after the
+    delimiter (in the output) are never truncated. The budget left after the text of the template and those fields
+    is shared between the string fields referenced by the prompt: fields shorter than their share are kept whole and
+    the rest of their share is redistributed to the longer fields, which are cut at whitespace but keep at least
+    their first token.
+    """
+
+    def __init__(self, max_length: int, length_function=count_whitespace_tokens, reserved: int = 0, cache_size=4096):
+        """
+        :param max_length: total length allowed for the prompt and output
+        :param length_function: function returning the length of a string
+        :param reserved: length kept aside, e.g. for answer choices shown in the prompt
+        :param cache_size: maximum number of cached length measurements
+        """
+        self.max_length = max_length
+        self.length_function = length_function
+        self.reserved = reserved
+        self.cache_size = cache_size
+        # Maps digests of measured texts to their lengths, so that the cache does not keep the texts alive
+        self._lengths: "OrderedDict[bytes, int]" = OrderedDict()
+        # Maps a Jinja source to the length of its own text and the names it only references after the delimiter
+        self._template_info: Dict[str, Tuple[int, Set[str]]] = {}
+
+    def measure(self, text: str) -> int:
+        """
+        Returns the length of a text, from the cache of the least recently measured texts if possible
+        """
+        key = hashlib.blake2b(text.encode("utf-8"), digest_size=16).digest()
+        length = self._lengths.get(key)
+        if length is not None:
+            self._lengths.move_to_end(key)
+            return length
+        length = self._lengths[key] = self.length_function(text)
+        if len(self._lengths) > self.cache_size:
+            self._lengths.popitem(last=False)
+        return length
+
+    def truncate_example(self, example, fields, jinja, delimeter="|||"):
+        """
+        Returns a copy of the example whose referenced string fields fit in the budget
+
+        :param example: the dataset example
+        :param fields: the fields referenced by the template
+        :param jinja: Jinja source of the template, whose own text is deducted from the budget
+        :param delimeter: separator between prompt and output, which is not part of the text
+        :raises ValueError: if the text of the template alone does not fit in the budget
+        """
+        template_info = self._template_info.get(jinja)
+        if template_info is None:
+            template_info = self._template_info[jinja] = self._analyze_template(jinja, delimeter)
+        template_length, output_names = template_info
+        budget = self.max_length - self.reserved - template_length
+        if budget <= 0:
+            raise ValueError(
+                f"The text of the template has length {template_length}, which leaves no room for the example fields "
+                f"in the truncation budget of {self.max_length} (with {self.reserved} reserved)."
+            )
+
+        lengths = {}
+        for field in fields:
+            if isinstance(example.get(field), str):
+                if field in output_names:
+                    # Output fields are kept whole, e.g. not to cut the targets of a training set
+                    budget -= self.measure(example[field])
+                else:
+                    lengths[field] = self.measure(example[field])
+        allocation = self.allocate(lengths, budget)
+        truncated_example = dict(example)
+        for field, length in allocation.items():
+            if length < lengths[field]:
+                truncated_text = self.truncate_text(example[field], length)
+                if not truncated_text:
+                    # Keeps the first token rather than an empty field, which would fail to render
+                    match = re.match(r"\s*\S+", example[field])
+                    truncated_text = match.group() if match is not None else example[field]
+                truncated_example[field] = truncated_text
+        return truncated_example
+
+    def _analyze_template(self, jinja, delimeter):
+        # Length of the text of a template, and the names it only references after the delimiter. The source is
+        # lexed rather than parsed, as the delimiter can be within control statements.
+        template_text = " ".join(node.data for node in env.parse(jinja).find_all(nodes.TemplateData))
+        prompt_names, output_names = set(), set()
+        names = prompt_names
+        for _, token_type, value in env.lex(jinja):
+            if token_type == "data" and delimeter in value:
+                names = output_names
+            elif token_type == "name":
+                names.add(value)
+        return self.measure(template_text.replace(delimeter, " ")), output_names - prompt_names
+
+    @staticmethod
+    def allocate(lengths: Dict[str, int], budget: int) -> Dict[str, int]:
+        """
+        Shares a budget between fields, giving as much as possible to the shortest fields first (max-min fairness)
+
+        :param lengths: length of each field
+        :param budget: total length to share
+        :return: maximum length of each field
+        """
+        allocation = {}
+        remaining = max(budget, 0)
+        pending = sorted(lengths, key=lengths.get)
+        while pending:
+            share = remaining // len(pending)
+            if lengths[pending[0]] <= share:
+                field = pending.pop(0)
+                allocation[field] = lengths[field]
+                remaining -= lengths[field]
+            else:
+                # All the remaining fields are longer than their share, which they split evenly
+                extra = remaining - share * len(pending)
+                for i, field in enumerate(pending):
+                    allocation[field] = share + (1 if i < extra else 0)
+                break
+        return allocation
+
+    def truncate_text(self, text: str, max_length: int) -> str:
+        """
+        Returns the longest prefix of a text, cut at whitespace, whose length is at most max_length
+
+        :param text: text to truncate
+        :param max_length: maximum length of the result
+        """
+        token_ends = [match.end() for match in re.finditer(r"\S+", text)]
+        low, high = 0, len(token_ends)
+        # Binary search on the number of whitespace-separated tokens kept
+        while low < high:
+            middle = (low + high + 1) // 2
+            if self.length_function(text[: token_ends[middle - 1]]) <= max_length:
+                low = middle
+            else:
+                high = middle - 1
+        return text[: token_ends[low - 1]] if low > 0 else ""
+
+
+class CompiledTemplateCache:
+    """
+    Bounded LRU cache of compiled Jinja templates.
+
+    Entries are keyed by the arguments of compile_template, i.e., the template source, the delimiter, the filters
+    applied to outputs (for the truncate/highlight/no_none options) and the answer choices rendered along. Each entry
+    can be tagged with the ids of the templates that requested it, so that all the entries of a template can be
+    invalidated when that template is edited.
+    """
+
+    def __init__(self, maxsize: int = COMPILED_TEMPLATE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        # Maps the compile_template arguments to (compiled template, ids of the owning templates)
+        self._entries = OrderedDict()
+        # Maps a template id to the keys of the entries it owns
+        self._owners: Dict[str, set] = defaultdict(set)
+        self._lock = threading.Lock()
+
+    def get(
+        self,
+        source: str,
+        delimeter: str,
+        output_filters: Tuple = (),
+        answer_choices: Optional[str] = None,
+        owner: Optional[str] = None,
+    ):
+        """
+        Returns the compiled template for a source, compiling it on a cache miss
+
+        :param source: Jinja source to compile
+        :param delimeter: separator between prompt and output
+        :param output_filters: see compile_template
+        :param answer_choices: see compile_template
+        :param owner: id of the template requesting the compilation, used for invalidation
+        :return: a jinja2.Template
+        """
+        key = (source, delimeter, output_filters, answer_choices)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                self._add_owner(key, entry, owner)
+                return entry[0]
+            self.misses += 1
+
+        # Compiles outside of the lock so that other threads are not blocked meanwhile
+        compiled = compile_template(source, delimeter, output_filters, answer_choices)
+
+        with self._lock:
+            entry = self._entries.setdefault(key, (compiled, set()))
+            self._entries.move_to_end(key)
+            self._add_owner(key, entry, owner)
+            while len(self._entries) > self.maxsize:
+                evicted_key, (_, evicted_owners) = self._entries.popitem(last=False)
+                for evicted_owner in evicted_owners:
+                    self._discard_owner_key(evicted_owner, evicted_key)
+                self.evictions += 1
+            return entry[0]
+
+    def invalidate(self, owner: str) -> None:
+        """
+        Drops all the entries requested by a template
+
+        :param owner: id of the template
+        """
+        with self._lock:
+            for key in self._owners.pop(owner, ()):
+                entry = self._entries.pop(key, None)
+                if entry is None:
+                    continue
+                for other_owner in entry[1]:
+                    if other_owner != owner:
+                        self._discard_owner_key(other_owner, key)
+
+    def clear(self) -> None:
+        """
+        Drops all the entries and resets the counters
+        """
+        with self._lock:
+            self._entries.clear()
+            self._owners.clear()
+            self.hits = self.misses = self.evictions = 0
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Returns the hit/miss/eviction counters along with the current and maximum sizes
+        """
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "size": len(self._entries),
+                "maxsize": self.maxsize,
+            }
 
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _add_owner(self, key, entry, owner) -> None:
+        if owner is not None:
+            entry[1].add(owner)
+            self._owners[owner].add(key)
+
+    def _discard_owner_key(self, owner, key) -> None:
+        keys = self._owners.get(owner)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._owners[owner]
+
+
+# Compiled templates shared by all Template instances
+compiled_templates = CompiledTemplateCache()
+
+if os.environ.get("PROMPTSOURCE_BYTECODE_CACHE"):
+    enable_bytecode_cache(
+        None if os.environ["PROMPTSOURCE_BYTECODE_CACHE"] == "1" else os.environ["PROMPTSOURCE_BYTECODE_CACHE"]
+    )
 
 
 class Template(yaml.YAMLObject):
@@ -278,6 +722,15 @@ class Template(yaml.YAMLObject):
     """
 
     yaml_tag = "!Template"
+    yaml_loader = yaml.YAMLObject.yaml_loader + [YAML_LOADER]
+
+    # Templates loaded from YAML files do not store a delimiter, so they fall back to this default
+    delimeter = "|||"
+
+    # Kinds of answer choices, see get_answer_choices_kind
+    STATIC_ANSWER_CHOICES = "static"
+    LABEL_INDEXED_ANSWER_CHOICES = "label_indexed"
+    DYNAMIC_ANSWER_CHOICES = "dynamic"
 
     def __init__(self, name, jinja, reference, metadata=None, answer_choices=None, delimeter="|||"):
         """
@@ -309,6 +762,10 @@ class Template(yaml.YAMLObject):
         self.answer_choices = answer_choices
         self.delimeter = delimeter
 
+    def __getstate__(self):
+        # Memoized values are not part of the template, so they are neither written to the YAML files nor pickled
+        return {key: value for key, value in self.__dict__.items() if not key.startswith("_")}
+
     def get_id(self):
         """
         Returns the id of the template
@@ -341,91 +798,260 @@ class Template(yaml.YAMLObject):
         """
         return self.answer_choices
 
+    @property
+    def referenced_fields(self):
+        """
+        Names of the example fields referenced by the prompt or by the answer choices. Only those fields are used when
+        applying the template, so loaders can restrict the decoded columns to them.
+
+        :return: frozenset of strings
+        """
+        # Computed once, and recomputed if the Jinja template or the answer choices expression changes
+        key = (self.jinja, self.answer_choices)
+        memo = self.__dict__.get("_referenced_fields_memo")
+        if memo is None or memo[0] != key:
+            variables = meta.find_undeclared_variables(env.parse(self.jinja))
+            if self.answer_choices is not None:
+                variables |= meta.find_undeclared_variables(env.parse(self.answer_choices))
+            variables.discard("answer_choices")
+            memo = (key, frozenset(variables))
+            self._referenced_fields_memo = memo
+        return memo[1]
+
     def get_answer_choices_list(self, example):
         """
         Returns a list of answer choices for a given example
 
         :return: list of strings, or None if get_answer_choices_expr is None
         """
-        jinja = self.get_answer_choices_expr()
-        if jinja is None:
-            return None
-
-        rtemplate = env.from_string(jinja)
-        protected_example = self._escape_pipe(example, self.delimeter)
-        rendered_choices = rtemplate.render(**protected_example)
-        return [self._unescape_pipe(answer_choice.strip(), self.delimeter) for answer_choice in rendered_choices.split(self.delimeter)]
+        return self._render_answer_choices(self._escape_pipe(example, self.delimeter, self.referenced_fields))
 
     def get_fixed_answer_choices_list(self):
         """
         Returns a list of answer choices that is static across examples, if possible
         :return: list of strings, or None if no static list exists
         """
-        jinja = self.get_answer_choices_expr()
-        if jinja is None:
-            return None
+        fixed_answer_choices = self._get_answer_choices_analysis()["fixed"]
+        return list(fixed_answer_choices) if fixed_answer_choices is not None else None
 
-        parse = env.parse(jinja)
-        variables = meta.find_undeclared_variables(parse)
-        if len(variables) == 0:
-            rtemplate = env.from_string(jinja)
-            rendered_choices = rtemplate.render()
-            return [answer_choice.strip() for answer_choice in rendered_choices.split(self.delimeter)]
-        else:
-            return None
+    def get_answer_choices_kind(self):
+        """
+        Returns how the answer choices depend on the example, which is computed once without rendering any example:
+        - STATIC_ANSWER_CHOICES if the answer choices are the same for every example
+        - LABEL_INDEXED_ANSWER_CHOICES if, in addition, the output is the answer choice indexed by an example field
+          (see get_answer_choices_label_field)
+        - DYNAMIC_ANSWER_CHOICES if the answer choices are computed from each example
+
+        :return: string, or None if get_answer_choices_expr is None
+        """
+        return self._get_answer_choices_analysis()["kind"]
 
-    def apply(self, example, truncate=False, highlight_variables=False, no_none=True):
+    def get_answer_choices_label_field(self):
+        """
+        Returns the example field whose value is the index of the output in the answer choices
+
+        :return: string, or None if the answer choices are not label-indexed
+        """
+        return self._get_answer_choices_analysis()["label_field"]
+
+    def apply(self, example, truncate=False, highlight_variables=False, no_none=True, rng=None):
         """
         Creates a prompt by applying this template to an example
 
         :param example: the dataset example to create a prompt for
-        :param truncate: if True, example fields will be truncated to TEXT_VAR_LENGTH chars
+        :param truncate: if True, example fields will be truncated to TEXT_VAR_LENGTH chars. If a TruncationBudget,
+                         the referenced fields will be truncated so that the prompt and output fit in its budget.
         :param highlight_variables: highlight the added variables
+        :param rng: random.Random used by the choice filter, e.g. from get_example_rng. Defaults to the global one.
         :return: tuple of 2 strings, for prompt and output
         """
-        jinja = self.jinja
+        if "answer_choices" in example:
+            raise ValueError("Example contains the restricted key 'answer_choices'.")
+
+        if isinstance(truncate, TruncationBudget):
+            example = truncate.truncate_example(example, self.referenced_fields, self.jinja, self.delimeter)
+            truncate = False
+
+        rtemplate = self._compile_prompt(truncate, highlight_variables, no_none)
+        protected_example = self._escape_pipe(example, self.delimeter, self.referenced_fields)
+        rendered_example, _ = self._render(rtemplate, protected_example, rng)
+        return rendered_example
+
+    def apply_batch(
+        self, batch, indices=None, truncate=False, highlight_variables=False, no_none=True, seed=None, split=None
+    ):
+        """
+        Creates prompts by applying this template to a batch of examples in columnar format, i.e., a dictionary
+        mapping each column name to the list of its values, as passed by `datasets.Dataset.map(batched=True)`
+
+        Only the columns referenced by the template are escaped, and rows that fail to render (or that do not split
+        into exactly a prompt and an output) get None values instead of aborting the whole batch.
+
+        :param batch: the batch of dataset examples to create prompts for
+        :param indices: indices of the examples in their split, as passed by `map(with_indices=True)`
+        :param truncate: if True, example fields will be truncated to TEXT_VAR_LENGTH chars. If a TruncationBudget,
+                         the referenced fields will be truncated so that each prompt and output fit in its budget.
+        :param highlight_variables: highlight the added variables
+        :param seed: if not None, the choice filter draws from get_example_rng(seed, template id, split, index) for
+                     each example, where index defaults to the position in the batch
+        :param split: split of the examples, used with seed
+        :return: dictionary with the "source", "target" and "answer_choices" columns
+        """
+        if "answer_choices" in batch:
+            raise ValueError("Batch contains the restricted column 'answer_choices'.")
+
+        num_rows = len(next(iter(batch.values()))) if batch else 0
+        columns = {column: batch[column] for column in self.referenced_fields if column in batch}
+        if isinstance(truncate, TruncationBudget):
+            truncated_rows = [
+                truncate.truncate_example(
+                    {column: values[i] for column, values in columns.items()}, columns, self.jinja, self.delimeter
+                )
+                for i in range(num_rows)
+            ]
+            columns = {column: [row[column] for row in truncated_rows] for column in columns}
+            truncate = False
+
+        protected_columns = {
+            column: self._escape_pipe_values(values, self.delimeter) for column, values in columns.items()
+        }
+        return self._apply_protected_batch(
+            protected_columns, num_rows, indices, truncate, highlight_variables, no_none, seed, split
+        )
+
+    def _apply_protected_batch(
+        self, protected_columns, num_rows, indices, truncate, highlight_variables, no_none, seed, split
+    ):
+        # Same as apply_batch, for referenced columns that are already escaped
+        rtemplate = self._compile_prompt(truncate, highlight_variables, no_none)
+        output = {"source": [], "target": [], "answer_choices": []}
+        for i in range(num_rows):
+            protected_example = {column: values[i] for column, values in protected_columns.items()}
+            rng = None
+            if seed is not None:
+                rng = get_example_rng(seed, self.id, split, indices[i] if indices is not None else i)
+            try:
+                rendered_example, answer_choices = self._render(rtemplate, protected_example, rng)
+            except Exception:
+                rendered_example = None
+            if rendered_example is not None and len(rendered_example) == 2:
+                output["source"].append(rendered_example[0])
+                output["target"].append(rendered_example[1])
+                output["answer_choices"].append(answer_choices)
+            else:
+                output["source"].append(None)
+                output["target"].append(None)
+                output["answer_choices"].append(None)
+        return output
+
+    def _compile_prompt(self, truncate, highlight_variables, no_none):
+        output_filters = []
 
         # Truncates the prompt if needed
         if truncate:
-            trunc_command = (
-                f" | string | truncate({TEXT_VAR_LENGTH}) }}}}"  # Escaping curly braces requires doubling them
-            )
-            jinja = jinja.replace("}}", trunc_command)
+            output_filters += [("string", ()), ("truncate", (TEXT_VAR_LENGTH,))]
 
         # Highlights text that was substituted for variables, if requested
         if highlight_variables:
-            jinja = jinja.replace("}}", " | highlight }}")
+            output_filters.append(("highlight", ()))
         if no_none:
-            jinja = jinja.replace("}}", " | no_none }}")
-        rtemplate = env.from_string(jinja)
+            output_filters.append(("no_none", ()))
 
-        protected_example = self._escape_pipe(example, self.delimeter)
+        # Answer choices that depend on the example are computed in the same pass as the prompt, and exported from the
+        # rendered template module
+        answer_choices = None
+        if self.answer_choices is not None and self._get_static_answer_choices() is None:
+            answer_choices = self.answer_choices
+        return self._compile(self.jinja, tuple(output_filters), answer_choices)
 
+    def _render(self, rtemplate, protected_example, rng=None):
         # Adds in answer_choices variable
-        if "answer_choices" in protected_example:
-            raise ValueError("Example contains the restricted key 'answer_choices'.")
-
-        protected_example["answer_choices"] = self.get_answer_choices_list(example)
+        static_answer_choices = self._get_static_answer_choices()
+        if static_answer_choices is not None:
+            context = {**protected_example, "answer_choices": list(static_answer_choices)}
+        else:
+            context = {**protected_example, "answer_choices": None}
+        if rng is not None:
+            context[RNG_CONTEXT_KEY] = rng
+        module = rtemplate.make_module(context)
 
         # Renders the Jinja template
-        rendered_example = rtemplate.render(**protected_example)
+        rendered_example = str(module)
+        answer_choices = getattr(module, "answer_choices", static_answer_choices)
 
         # Splits on the separator, and then replaces back any occurrences of the
         # separator in the original example
-        return [self._unescape_pipe(part, self.delimeter).strip() for part in rendered_example.split(self.delimeter)]
+        rendered_example = [
+            self._unescape_pipe(part, self.delimeter).strip() for part in rendered_example.split(self.delimeter)
+        ]
+        return rendered_example, answer_choices
+
+    def _render_answer_choices(self, protected_example):
+        jinja = self.get_answer_choices_expr()
+        if jinja is None:
+            return None
+
+        rtemplate = self._compile(jinja)
+        rendered_choices = rtemplate.render(**protected_example)
+        return split_answer_choices(rendered_choices, self.delimeter)
+
+    def _get_static_answer_choices(self):
+        # Answer choices which do not depend on the example are only rendered once
+        return self._get_answer_choices_analysis()["static"]
+
+    def _get_answer_choices_analysis(self):
+        # Computed once, and recomputed if the Jinja template, the answer choices expression or the delimiter changes
+        key = (self.jinja, self.answer_choices, self.delimeter)
+        memo = self.__dict__.get("_answer_choices_memo")
+        if memo is None or memo[0] != key:
+            analysis = {"fixed": None, "static": None, "kind": None, "label_field": None}
+            if self.answer_choices is not None:
+                parse = env.parse(self.answer_choices)
+                if len(meta.find_undeclared_variables(parse)) == 0:
+                    rendered_choices = self._compile(self.answer_choices).render()
+                    analysis["fixed"] = [choice.strip() for choice in rendered_choices.split(self.delimeter)]
+
+                # Fixed answer choices drawn with the choice filter still differ between examples
+                is_random = any(node.name == "choice" for node in parse.find_all(nodes.Filter))
+                if analysis["fixed"] is None or is_random:
+                    analysis["kind"] = self.DYNAMIC_ANSWER_CHOICES
+                else:
+                    analysis["static"] = split_answer_choices(rendered_choices, self.delimeter)
+                    parts = self.jinja.split(self.delimeter)
+                    match = LABEL_INDEXED_OUTPUT.match(parts[-1]) if len(parts) > 1 else None
+                    if match is not None and match.group(1) in self.referenced_fields:
+                        analysis["kind"] = self.LABEL_INDEXED_ANSWER_CHOICES
+                        analysis["label_field"] = match.group(1)
+                    else:
+                        analysis["kind"] = self.STATIC_ANSWER_CHOICES
+            memo = (key, analysis)
+            self._answer_choices_memo = memo
+        return memo[1]
+
+    def _compile(self, source, output_filters=(), answer_choices=None):
+        # Compiled templates are shared through the module-level cache and tagged with this template's id
+        return compiled_templates.get(source, self.delimeter, output_filters, answer_choices, owner=self.id)
 
     pipe_protector = "3ed2dface8203c4c9dfb1a5dc58e41e0"
 
     @classmethod
-    def _escape_pipe(cls, example, delimeter):
+    def _escape_pipe(cls, example, delimeter, fields=None):
         # Replaces any occurrences of the self.delimeter separator in the example, which
-        # which will be replaced back after splitting
+        # which will be replaced back after splitting. If fields is given, only those
+        # fields are kept.
+        if fields is not None:
+            example = {key: example[key] for key in fields if key in example}
         protected_example = {
             key: value.replace(delimeter, cls.pipe_protector) if isinstance(value, str) else value
             for key, value in example.items()
         }
         return protected_example
 
+    @classmethod
+    def _escape_pipe_values(cls, values, delimeter):
+        # Same as _escape_pipe, for the list of values of a single column
+        return [value.replace(delimeter, cls.pipe_protector) if isinstance(value, str) else value for value in values]
+
     @classmethod
     def _unescape_pipe(cls, string, delimeter):
         # replaces back any occurrences of the separator in a string
@@ -437,6 +1063,7 @@ class Template(yaml.YAMLObject):
         """
 
         yaml_tag = "!TemplateMetadata"
+        yaml_loader = yaml.YAMLObject.yaml_loader + [YAML_LOADER]
 
         def __init__(
             self,
@@ -465,56 +1092,111 @@ class Template(yaml.YAMLObject):
             self.languages = languages
 
 
+# Templates are only registered with the pure Python dumper by yaml.YAMLObject
+YAML_C_DUMPER.add_representer(Template, Template.to_yaml)
+YAML_C_DUMPER.add_representer(Template.Metadata, Template.Metadata.to_yaml)
+
+
+# Fields of the TemplateCollection indexes, mapped to the function listing the values of a template for the field
+INDEXED_FIELDS: Dict[str, Callable[[Template], List]] = {
+    "template_id": lambda template: [template.get_id()],
+    "name": lambda template: [template.get_name()],
+    "language": lambda template: list(getattr(template.metadata, "languages", None) or []),
+    "metric": lambda template: list(getattr(template.metadata, "metrics", None) or []),
+    "original_task": lambda template: [getattr(template.metadata, "original_task", None)],
+    "choices_in_prompt": lambda template: [getattr(template.metadata, "choices_in_prompt", None)],
+    "has_answer_choices": lambda template: [template.answer_choices is not None],
+    "answer_choices_kind": lambda template: [template.get_answer_choices_kind()],
+}
+
+
 class TemplateCollection:
     """
     This helper class wraps the DatasetTemplates class
-    - Initialized the DatasetTemplates for all existing template folder
-    - Give access to each DatasetTemplates
+    - Discovers the DatasetTemplates of all existing template folders
+    - Give access to each DatasetTemplates, which is loaded on first access
     - Provides aggregated counts over all DatasetTemplates
     """
 
+    # Version of the format of the file saved by get_by_id
+    ID_INDEX_VERSION = 1
+
     def __init__(self):
-        # Dict of all the DatasetTemplates, key is the tuple (dataset_name, subset_name)
-        self.datasets_templates: Dict[(str, Optional[str]), DatasetTemplates] = self._collect_datasets()
+        # Dict of the DatasetTemplates loaded so far, key is the tuple (dataset_name, subset_name)
+        self.datasets_templates: Dict[(str, Optional[str]), DatasetTemplates] = {}
+        # Keys of all the DatasetTemplates, in discovery order. Only the folder tree is listed, and no file is read.
+        self._dataset_keys: Dict[Tuple[str, Optional[str]], None] = self._collect_datasets()
+        # Secondary indexes over all the templates, with key=field and value={value: set of template ids}, see query
+        self._indexes: Optional[Dict[str, Dict]] = None
+        # Dict with key=template id and value=(dataset key, template, indexed values of the template)
+        self._indexed_templates: Dict[str, Tuple[Tuple[str, Optional[str]], Template, Dict[str, List]]] = {}
+        # Index with key=template id and value=(dataset_name, subset_name, template_name), see get_by_id
+        self._id_index: Optional[Dict[str, Tuple[str, Optional[str], str]]] = None
+        # Signatures of the YAML files the id index was built from, see refresh
+        self._id_index_signatures: Dict[Tuple[str, Optional[str]], Optional[Tuple[int, int]]] = {}
+        # Thread started by start_watcher, and the event stopping it
+        self._watcher: Optional[threading.Thread] = None
+        self._watcher_stop = threading.Event()
+        self._refresh_lock = threading.Lock()
+        # Batches of the DatasetTemplates of the collection, and the dumper writing them, see batch
+        self._batches: Optional[contextlib.ExitStack] = None
+        self._batch_dumper = yaml.Dumper
 
     @property
     def keys(self):
-        return list(self.datasets_templates.keys())
+        return list(self._dataset_keys)
 
     def __len__(self) -> int:
-        return len(self.datasets_templates)
+        return len(self._dataset_keys)
 
-    def remove(self, dataset_name: str, subset_name: Optional[str] = None) -> None:
-        del self.datasets_templates[dataset_name, subset_name]
+    def __contains__(self, key: Tuple[str, Optional[str]]) -> bool:
+        return key in self._dataset_keys
 
-    def _collect_datasets(self) -> Dict[Tuple[str, str], "DatasetTemplates"]:
+    def remove(self, dataset_name: str, subset_name: Optional[str] = None) -> None:
+        del self._dataset_keys[dataset_name, subset_name]
+        dataset_templates = self.datasets_templates.pop((dataset_name, subset_name), None)
+        if dataset_templates is not None:
+            self._forget_dataset_templates(dataset_templates)
+        if self._id_index is not None:
+            self._id_index = {
+                template_id: location
+                for template_id, location in self._id_index.items()
+                if location[:2] != (dataset_name, subset_name)
+            }
+
+    def _forget_dataset_templates(self, dataset_templates: "DatasetTemplates") -> None:
+        # Drops the templates of a DatasetTemplates that left the collection from the caches and indexes
+        for template_id in dataset_templates.templates:
+            compiled_templates.invalidate(template_id)
+            if self._indexes is not None:
+                self._unindex_template(template_id)
+
+    def _collect_datasets(self) -> Dict[Tuple[str, Optional[str]], None]:
         """
-        Initialize a DatasetTemplates object for each templates.yaml detected in the templates folder
+        Lists the keys of the DatasetTemplates for each templates.yaml detected in the templates folder
 
-        Returns: a dict with key=(dataset_name, subset_name)
+        Returns: a dict with key=(dataset_name, subset_name) and None values, used as an ordered set
         """
         dataset_folders = os.listdir(TEMPLATES_FOLDER_PATH)
         dataset_folders = [folder for folder in dataset_folders if not folder.startswith(".")]
 
-        output = {}  # format is {(dataset_name, subset_name): DatasetsTemplates}
+        output = {}  # format is {(dataset_name, subset_name): None}
         for dataset in dataset_folders:
             if dataset in INCLUDED_USERS:
                 for filename in os.listdir(os.path.join(TEMPLATES_FOLDER_PATH, dataset)):
-                    output = {**output, **self._collect_dataset(dataset + "/" + filename)}
+                    self._collect_dataset(dataset + "/" + filename, output)
             else:
-                output = {**output, **self._collect_dataset(dataset)}
+                self._collect_dataset(dataset, output)
         return output
 
-    def _collect_dataset(self, dataset):
-        output = {}  # format is {(dataset_name, subset_name): DatasetsTemplates}
+    def _collect_dataset(self, dataset, output):
         for filename in os.listdir(os.path.join(TEMPLATES_FOLDER_PATH, dataset)):
             if filename.endswith(".yaml"):
                 # If there is no sub-folder, there is no subset for this dataset
-                output[(dataset, None)] = DatasetTemplates(dataset)
+                output[(dataset, None)] = None
             else:
                 # This is a subfolder, and its name corresponds to the subset name
-                output[(dataset, filename)] = DatasetTemplates(dataset_name=dataset, subset_name=filename)
-        return output
+                output[(dataset, filename)] = None
 
     def get_dataset(self, dataset_name: str, subset_name: Optional[str] = None) -> "DatasetTemplates":
         """
@@ -523,11 +1205,330 @@ class TemplateCollection:
         :param dataset_name: name of the dataset to get
         :param subset_name: name of the subset
         """
-        # if the dataset does not exist, we add it
-        if dataset_name not in self.keys:
-            self.datasets_templates[(dataset_name, subset_name)] = DatasetTemplates(dataset_name, subset_name)
+        key = (dataset_name, subset_name)
+        dataset_templates = self.datasets_templates.get(key)
+        # the templates are read on first access, and if the dataset does not exist, we add it
+        if dataset_templates is None:
+            dataset_templates = DatasetTemplates(dataset_name, subset_name)
+            self._add_dataset_templates(key, dataset_templates)
+        return dataset_templates
+
+    def _add_dataset_templates(self, key: Tuple[str, Optional[str]], dataset_templates: "DatasetTemplates") -> None:
+        self.datasets_templates[key] = dataset_templates
+        self._dataset_keys[key] = None
+        if self._indexes is not None:
+            self._index_dataset_templates(key, dataset_templates)
+        dataset_templates.add_listener(functools.partial(self._on_template_change, key, dataset_templates))
+        if self._batches is not None:
+            self._join_batch(dataset_templates)
+
+    @contextlib.contextmanager
+    def batch(self, use_c_dumper: bool = False):
+        """
+        Defers the writes of all the DatasetTemplates of the collection until the end of the block, where each
+        modified file is written once, see DatasetTemplates.batch. If the block raises, the changes of all the
+        DatasetTemplates are rolled back.
+
+        >>> with template_collection.batch():
+        ...     for dataset_name, subset_name, template in template_collection.query(language="en"):
+        ...         dataset_templates = template_collection.get_dataset(dataset_name, subset_name)
+        ...         dataset_templates.update_template(...)
+
+        :param use_c_dumper: if True, files are written with libyaml's dumper when available. It is several times
+            faster, but folds long strings differently from the pure Python dumper, so more lines of the files change.
+        """
+        if self._batches is not None:
+            yield self
+            return
+        self._batch_dumper = YAML_C_DUMPER if use_c_dumper else yaml.Dumper
+        with contextlib.ExitStack() as self._batches:
+            try:
+                for dataset_templates in self.datasets_templates.values():
+                    self._join_batch(dataset_templates)
+                yield self
+            finally:
+                # Pending changes are written while the stack unwinds
+                self._batches = None
+
+    def _join_batch(self, dataset_templates: "DatasetTemplates") -> None:
+        self._batches.callback(setattr, dataset_templates, "_yaml_dumper", dataset_templates._yaml_dumper)
+        self._batches.enter_context(dataset_templates.batch())
+        dataset_templates._yaml_dumper = self._batch_dumper
+
+    def load_all(self, max_workers: Optional[int] = None, use_processes: bool = False) -> Dict:
+        """
+        Loads all the DatasetTemplates that are not loaded yet, reading their files concurrently
+
+        :param max_workers: number of threads or processes, see concurrent.futures
+        :param use_processes: if True, parses the files in a process pool instead of a thread pool
+        :return: dict with key=(dataset_name, subset_name) and value=seconds spent reading the file
+        """
+        keys = [key for key in self._dataset_keys if key not in self.datasets_templates]
+        executor_class = (
+            concurrent.futures.ProcessPoolExecutor if use_processes else concurrent.futures.ThreadPoolExecutor
+        )
+        timings = {}
+        start = time.perf_counter()
+        with executor_class(max_workers=max_workers) as executor:
+            for key, dataset_templates, seconds in executor.map(_read_dataset_templates, keys):
+                self._add_dataset_templates(key, dataset_templates)
+                timings[key] = seconds
+        logging.info(
+            f"Loaded {len(keys)} DatasetTemplates in {time.perf_counter() - start:.2f}s "
+            f"({sum(timings.values()):.2f}s spent reading files)"
+        )
+        return timings
+
+    def query(self, **criteria) -> List[Tuple[str, Optional[str], "Template"]]:
+        """
+        Finds the templates matching all the given criteria, using indexes built over all the templates on the first
+        use of each criterion and kept in sync with the changes made through DatasetTemplates methods
+
+        Supported criteria are the keys of INDEXED_FIELDS, e.g. `query(language="en", metric="Accuracy",
+        original_task=True, answer_choices_kind=Template.STATIC_ANSWER_CHOICES)`.
+        A language or a metric matches the templates whose metadata lists it.
+
+        :return: list of (dataset_name, subset_name, template), sorted by dataset, subset and template name
+        """
+        unknown_criteria = set(criteria) - set(INDEXED_FIELDS)
+        if unknown_criteria:
+            raise ValueError(
+                f"Unknown query criteria {sorted(unknown_criteria)}, expected some of {sorted(INDEXED_FIELDS)}"
+            )
+        self._build_indexes(criteria)
+
+        if criteria:
+            # Intersects the smallest sets first, so that the cost is bounded by the smallest of them
+            id_sets = sorted((self._indexes[field].get(value, ()) for field, value in criteria.items()), key=len)
+            template_ids = set(id_sets[0]).intersection(*id_sets[1:])
+        else:
+            template_ids = self._indexed_templates.keys()
+
+        results = []
+        for template_id in template_ids:
+            key, template, _ = self._indexed_templates[template_id]
+            results.append((key[0], key[1], template))
+        return sorted(results, key=lambda result: (result[0], result[1] or "", result[2].name))
+
+    def _build_indexes(self, fields) -> None:
+        if self._indexes is None:
+            self.load_all()
+            self._indexes = {}
+            for key, dataset_templates in self.datasets_templates.items():
+                self._index_dataset_templates(key, dataset_templates)
+        # The index of a field is only built when it is first queried, as some values are costly to compute
+        for field in fields:
+            if field not in self._indexes:
+                self._indexes[field] = defaultdict(set)
+                for template_id, (_, template, values) in self._indexed_templates.items():
+                    values[field] = INDEXED_FIELDS[field](template)
+                    for value in values[field]:
+                        self._indexes[field][value].add(template_id)
+
+    def _index_dataset_templates(self, key: Tuple[str, Optional[str]], dataset_templates: "DatasetTemplates") -> None:
+        for template in dataset_templates.templates.values():
+            self._index_template(key, template)
+
+    def _index_template(self, key: Tuple[str, Optional[str]], template: "Template") -> None:
+        template_id = template.get_id()
+        values = {field: INDEXED_FIELDS[field](template) for field in self._indexes}
+        for field, field_values in values.items():
+            for value in field_values:
+                self._indexes[field][value].add(template_id)
+        self._indexed_templates[template_id] = (key, template, values)
+
+    def _unindex_template(self, template_id: str) -> None:
+        indexed = self._indexed_templates.pop(template_id, None)
+        if indexed is None:
+            return
+        for field, field_values in indexed[2].items():
+            for value in field_values:
+                template_ids = self._indexes[field][value]
+                template_ids.discard(template_id)
+                if not template_ids:
+                    del self._indexes[field][value]
+
+    def _on_template_change(
+        self, key: Tuple[str, Optional[str]], dataset_templates: "DatasetTemplates", event: str, template: "Template"
+    ) -> None:
+        # Listener of the DatasetTemplates of the collection, see DatasetTemplates.add_listener
+        if self.datasets_templates.get(key) is not dataset_templates:
+            return
+        if self._indexes is not None:
+            self._unindex_template(template.get_id())
+            if event != "remove":
+                self._index_template(key, template)
+        if self._id_index is not None:
+            if event == "remove":
+                self._id_index.pop(template.get_id(), None)
+            else:
+                self._id_index[template.get_id()] = (key[0], key[1], template.get_name())
+
+    def get_by_id(self, template_id: str) -> "Template":
+        """
+        Return the template with the given id, only loading the DatasetTemplates that contains it
+
+        The index mapping ids to templates is saved in the file given by get_template_id_index_path, and only the
+        entries of the YAML files modified since then are rebuilt.
+
+        :param template_id: id of the template
+        :raises KeyError: if no template has this id
+        """
+        self._build_id_index()
+        if template_id not in self._id_index:
+            raise KeyError(f"No template with id {template_id}")
+        dataset_name, subset_name, _ = self._id_index[template_id]
+        templates = self.get_dataset(dataset_name, subset_name).templates
+        if template_id not in templates:
+            raise KeyError(f"No template with id {template_id} in dataset {dataset_name}/{subset_name}")
+        return templates[template_id]
+
+    def _build_id_index(self) -> None:
+        if self._id_index is not None:
+            return
+        index_path = get_template_id_index_path()
+        templates_folder = os.path.abspath(TEMPLATES_FOLDER_PATH)
+        # The saved index has key=(dataset_name, subset_name) and value=(signature of the YAML file, {id: name})
+        saved_entries = {}
+        try:
+            with open(index_path, "rb") as index_file:
+                saved_index = pickle.load(index_file)
+            if saved_index["version"] == self.ID_INDEX_VERSION and saved_index["templates_folder"] == templates_folder:
+                saved_entries = saved_index["entries"]
+        except (OSError, EOFError, KeyError, TypeError, ValueError, pickle.UnpicklingError):
+            pass
+
+        entries = {}
+        stale_keys = []
+        # Keys of the loaded datasets whose templates differ from their files, which are indexed but not saved
+        unsaved_keys = set()
+        for key in self._dataset_keys:
+            signature = _get_file_signature(DatasetTemplates.get_yaml_path(*key))
+            if key in saved_entries and saved_entries[key][0] == signature:
+                entries[key] = saved_entries[key]
+            elif key in self.datasets_templates:
+                dataset_templates = self.datasets_templates[key]
+                if dataset_templates._has_pending_changes or dataset_templates.is_file_modified():
+                    unsaved_keys.add(key)
+                templates = dataset_templates.templates
+                entries[key] = (signature, {template_id: template.name for template_id, template in templates.items()})
+            else:
+                entries[key] = (signature, None)
+                stale_keys.append(key)
+        with concurrent.futures.ThreadPoolExecutor() as executor:
+            for key, dataset_templates, _ in executor.map(_read_dataset_templates, stale_keys):
+                templates = dataset_templates.templates
+                template_names = {template_id: template.name for template_id, template in templates.items()}
+                entries[key] = (entries[key][0], template_names)
+
+        id_index = {}
+        for key, (_, template_names) in entries.items():
+            for template_id, template_name in template_names.items():
+                if template_id in id_index:
+                    other_dataset_name, other_subset_name, other_template_name = id_index[template_id]
+                    raise ValueError(
+                        f"Template {template_name} for dataset {key[0]}/{key[1]} has duplicate uuid {template_id} as "
+                        f"template {other_template_name} for dataset {other_dataset_name}/{other_subset_name}."
+                    )
+                id_index[template_id] = (key[0], key[1], template_name)
+        self._id_index = id_index
+        self._id_index_signatures = {key: signature for key, (signature, _) in entries.items()}
+
+        entries = {key: entry for key, entry in entries.items() if key not in unsaved_keys}
+        entries.update((key, saved_entries[key]) for key in unsaved_keys if key in saved_entries)
+        if entries != saved_entries:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(index_path)), exist_ok=True)
+                temporary_path = f"{index_path}.{os.getpid()}.tmp"
+                with open(temporary_path, "wb") as index_file:
+                    pickle.dump(
+                        {"version": self.ID_INDEX_VERSION, "templates_folder": templates_folder, "entries": entries},
+                        index_file,
+                        protocol=pickle.HIGHEST_PROTOCOL,
+                    )
+                os.replace(temporary_path, index_path)
+            except OSError as e:
+                logging.warning(f"Could not save the template id index to {index_path}: {e}")
+
+    def refresh(self) -> Dict[str, List[Tuple[str, Optional[str]]]]:
+        """
+        Brings the collection up to date with the templates folder, only reloading the DatasetTemplates whose YAML
+        file changed since they were loaded. The compiled templates and the indexes of the other datasets are kept.
+
+        :return: dict with the keys of the "added", "removed" and "modified" datasets
+        """
+        with self._refresh_lock:
+            dataset_keys = self._collect_datasets()
+            added = [key for key in dataset_keys if key not in self._dataset_keys]
+            removed = [key for key in self._dataset_keys if key not in dataset_keys]
+            for key in removed:
+                self.remove(*key)
+
+            modified = []
+            for key, dataset_templates in list(self.datasets_templates.items()):
+                if dataset_templates.is_file_modified():
+                    modified.append(key)
+                    self._forget_dataset_templates(dataset_templates)
+                    if self._id_index is not None:
+                        for template_id in dataset_templates.templates:
+                            self._id_index.pop(template_id, None)
+                    # The listener of the replaced DatasetTemplates is ignored from now on
+                    self._add_dataset_templates(key, DatasetTemplates(*key))
+                    if self._id_index is not None:
+                        for template in self.datasets_templates[key].templates.values():
+                            self._id_index[template.get_id()] = (key[0], key[1], template.get_name())
+                        self._id_index_signatures[key] = _get_file_signature(DatasetTemplates.get_yaml_path(*key))
+
+            for key in added:
+                self._dataset_keys[key] = None
+                if self._indexes is not None:
+                    # Indexes cover all the templates, so new datasets are loaded right away
+                    self.get_dataset(*key)
+
+            # The id index is rebuilt on next use if a dataset that is not loaded changed, from its saved version
+            if self._id_index is not None and any(
+                _get_file_signature(DatasetTemplates.get_yaml_path(*key)) != self._id_index_signatures.get(key)
+                for key in self._dataset_keys
+                if key not in self.datasets_templates
+            ):
+                self._id_index = None
+
+        if added or removed or modified:
+            logging.info(f"Refreshed templates: {len(added)} added, {len(removed)} removed, {len(modified)} modified")
+        return {"added": added, "removed": removed, "modified": modified}
+
+    def start_watcher(self, interval: float = 1.0, callback: Optional[Callable[[Dict], None]] = None) -> None:
+        """
+        Starts a daemon thread calling refresh every `interval` seconds, until stop_watcher is called
 
-        return self.datasets_templates[(dataset_name, subset_name)]
+        :param interval: seconds between two refreshes
+        :param callback: function called with the output of refresh when some datasets changed
+        """
+        if self._watcher is not None:
+            raise RuntimeError("The watcher of this TemplateCollection is already running.")
+
+        def watch():
+            while not self._watcher_stop.wait(interval):
+                try:
+                    changes = self.refresh()
+                except Exception as e:
+                    logging.warning(f"Could not refresh the templates: {e}")
+                    continue
+                if callback is not None and any(changes.values()):
+                    callback(changes)
+
+        self._watcher_stop.clear()
+        self._watcher = threading.Thread(target=watch, name="promptsource-templates-watcher", daemon=True)
+        self._watcher.start()
+
+    def stop_watcher(self) -> None:
+        """
+        Stops the thread started by start_watcher
+        """
+        if self._watcher is not None:
+            self._watcher_stop.set()
+            self._watcher.join()
+            self._watcher = None
 
     def get_templates_count(self) -> Dict:
         """
@@ -538,13 +1539,38 @@ class TemplateCollection:
         """
 
         count_dict = defaultdict(int)
-        for k, v in self.datasets_templates.items():
+        for k in self._dataset_keys:
             # Subsets count towards dataset count
-            count_dict[k[0]] += len(v)
+            if k in self.datasets_templates:
+                count_dict[k[0]] += len(self.datasets_templates[k])
+            else:
+                count_dict[k[0]] += DatasetTemplates.count_templates_in_file(k[0], k[1])
         # converting to regular dict
         return dict(count_dict)
 
 
+def _read_dataset_templates(key):
+    # Reads the templates of a dataset in a TemplateCollection.load_all worker
+    start = time.perf_counter()
+    dataset_templates = DatasetTemplates(*key)
+    return key, dataset_templates, time.perf_counter() - start
+
+
+def _get_file_signature(path: str) -> Optional[Tuple[int, int]]:
+    # Modification time and size of a file, or None if it does not exist
+    try:
+        file_stat = os.stat(path)
+    except OSError:
+        return None
+    return file_stat.st_mtime_ns, file_stat.st_size
+
+
+class TemplatesFileConflictError(RuntimeError):
+    """
+    Raised when writing a templates.yaml file that was modified by someone else since it was read
+    """
+
+
 class DatasetTemplates:
     """
     Class that wraps all templates for a specific dataset/subset and implements all the helper
@@ -557,14 +1583,112 @@ class DatasetTemplates:
     TEMPLATE_FILENAME = "templates.yaml"
 
     def __init__(self, dataset_name: str, subset_name: str = None):
+        """
+        :param dataset_name: name of the dataset
+        :param subset_name: name of the subset
+        """
         self.dataset_name: str = dataset_name
         self.subset_name: str = subset_name
-        # dictionary is keyed by template name.
+        # (modification time, size, SHA-256 hash) of the YAML file when it was last read or written, see
+        # is_file_modified
+        self.file_fingerprint: Optional[Tuple[int, int, str]] = None
+        # dictionary is keyed by template id.
         self.templates: Dict = self.read_from_file()
 
         # Mapping from template name to template id
         self.name_to_id_mapping = {}
         self.sync_mapping()
+        # Functions called after each change of the templates, see add_listener
+        self._listeners: List[Callable[[str, "Template"], None]] = []
+        # Number of nested batches, and whether changes were made since the file was written, see batch
+        self._batch_depth = 0
+        self._has_pending_changes = False
+        # Dumper used by flush, see TemplateCollection.batch
+        self._yaml_dumper = yaml.Dumper
+
+    @contextlib.contextmanager
+    def batch(self):
+        """
+        Defers the writes of add_template, remove_template and update_template until the end of the block, where the
+        file is written once. The block is a transaction: if it raises, or if the file cannot be written (e.g. on a
+        TemplatesFileConflictError), nothing is written and the templates are restored as they were before the block.
+
+        >>> with dataset_templates.batch():
+        ...     for template in templates:
+        ...         dataset_templates.add_template(template)
+        """
+        if self._batch_depth > 0:
+            # Nested batches are part of the outermost one
+            self._batch_depth += 1
+            try:
+                yield self
+            finally:
+                self._batch_depth -= 1
+            return
+
+        snapshot = self._snapshot()
+        self._batch_depth += 1
+        try:
+            yield self
+            self._batch_depth -= 1
+            self.flush()
+        except BaseException:
+            self._batch_depth = 0
+            self._rollback(snapshot)
+            raise
+
+    def _snapshot(self) -> Dict[str, Tuple["Template", Dict]]:
+        # State of the templates restored by _rollback, with copies of their attributes as they are updated in place
+        return {template_id: (template, dict(vars(template))) for template_id, template in self.templates.items()}
+
+    def _rollback(self, snapshot: Dict[str, Tuple["Template", Dict]]) -> None:
+        # Restores the templates as they were when the snapshot was taken, and tells the listeners about it
+        events = []
+        for template_id, template in self.templates.items():
+            if template_id not in snapshot:
+                compiled_templates.invalidate(template_id)
+                events.append(("remove", template))
+        for template_id, (template, attributes) in snapshot.items():
+            if template_id not in self.templates:
+                events.append(("add", template))
+            elif vars(template) != attributes:
+                events.append(("update", template))
+            else:
+                continue
+            compiled_templates.invalidate(template_id)
+            vars(template).clear()
+            vars(template).update(attributes)
+        self.templates.clear()
+        self.templates.update((template_id, template) for template_id, (template, _) in snapshot.items())
+        self.sync_mapping()
+        self._has_pending_changes = False
+        for event, template in events:
+            self._notify(event, template)
+
+    def flush(self) -> None:
+        """
+        Writes the changes made so far in a batch, see batch
+        """
+        if not self._has_pending_changes:
+            return
+        if len(self.templates) == 0:
+            # There is no remaining template, we can remove the entire folder
+            if os.path.exists(self.folder_path):
+                self.delete_folder()
+        else:
+            self.write_to_file()
+        self._has_pending_changes = False
+
+    def add_listener(self, listener: Callable[[str, "Template"], None]) -> None:
+        """
+        Registers a function called as listener(event, template) after each change made through add_template,
+        remove_template or update_template, with event "add", "remove" or "update" respectively
+        """
+        self._listeners.append(listener)
+
+    def _notify(self, event: str, template: "Template") -> None:
+        for listener in self._listeners:
+            listener(event, template)
 
     def sync_mapping(self) -> None:
         """
@@ -581,15 +1705,37 @@ class DatasetTemplates:
 
     @property
     def folder_path(self) -> str:
-        if self.subset_name:
-            return os.path.join(TEMPLATES_FOLDER_PATH, self.dataset_name, self.subset_name)
-        else:
-            return os.path.join(TEMPLATES_FOLDER_PATH, self.dataset_name)
+        return self.get_folder_path(self.dataset_name, self.subset_name)
 
     @property
     def yaml_path(self) -> str:
         return os.path.join(self.folder_path, self.TEMPLATE_FILENAME)
 
+    @classmethod
+    def get_yaml_path(cls, dataset_name: str, subset_name: Optional[str] = None) -> str:
+        return os.path.join(cls.get_folder_path(dataset_name, subset_name), cls.TEMPLATE_FILENAME)
+
+    @staticmethod
+    def get_folder_path(dataset_name: str, subset_name: Optional[str] = None) -> str:
+        if subset_name:
+            return os.path.join(TEMPLATES_FOLDER_PATH, dataset_name, subset_name)
+        else:
+            return os.path.join(TEMPLATES_FOLDER_PATH, dataset_name)
+
+    @classmethod
+    def count_templates_in_file(cls, dataset_name: str, subset_name: Optional[str] = None) -> int:
+        """
+        Counts the templates of a dataset by scanning its YAML file for template tags, without parsing it
+
+        :param dataset_name: name of the dataset
+        :param subset_name: name of the subset
+        """
+        yaml_path = cls.get_yaml_path(dataset_name, subset_name)
+        if not os.path.exists(yaml_path):
+            return 0
+        with open(yaml_path, "rb") as yaml_file:
+            return len(TEMPLATE_TAG_PATTERN.findall(yaml_file.read()))
+
     def format_for_dump(self) -> Dict:
         """
         Create a formatted dictionary for the class attributes
@@ -611,7 +1757,20 @@ class DatasetTemplates:
                 "Please ignore this warning if you are creating new prompts for this dataset."
             )
             return {}
-        yaml_dict = yaml.load(open(self.yaml_path, "r"), Loader=yaml.FullLoader)
+        with open(self.yaml_path, "rb") as yaml_file:
+            yaml_bytes = yaml_file.read()
+            yaml_stat = os.fstat(yaml_file.fileno())
+        yaml_hash = hashlib.sha256(yaml_bytes).hexdigest()
+        self.file_fingerprint = (yaml_stat.st_mtime_ns, yaml_stat.st_size, yaml_hash)
+
+        # Uses the precompiled pack if it contains this exact file
+        templates_pack = get_templates_pack()
+        if templates_pack is not None:
+            templates = templates_pack.load(self.dataset_name, self.subset_name, yaml_hash)
+            if templates is not None:
+                return templates
+
+        yaml_dict = yaml.load(yaml_bytes, Loader=YAML_LOADER)
         return yaml_dict[self.TEMPLATES_KEY]
 
     def write_to_file(self) -> None:
@@ -623,8 +1782,72 @@ class DatasetTemplates:
 
         # We only create the folder if a template is written
         if not os.path.exists(self.folder_path):
-            os.makedirs(self.folder_path)
-        yaml.dump(self.format_for_dump(), open(self.yaml_path, "w"))
+            os.makedirs(self.folder_path, exist_ok=True)
+        yaml_bytes = yaml.dump(self.format_for_dump(), Dumper=self._yaml_dumper).encode("utf-8")
+
+        # The file is replaced at once by a complete copy, so that readers and crashes never see a partial file. The
+        # copy ends with .yaml so that listing the templates folder meanwhile does not mistake it for a subset.
+        temporary_filename = f".{os.getpid()}-{threading.get_ident()}.{self.TEMPLATE_FILENAME}"
+        temporary_path = os.path.join(self.folder_path, temporary_filename)
+        with self._lock_folder() as folder_fd:
+            self._check_file_version()
+            try:
+                with open(temporary_path, "wb") as yaml_file:
+                    yaml_file.write(yaml_bytes)
+                    yaml_file.flush()
+                    os.fsync(yaml_file.fileno())
+                    yaml_stat = os.fstat(yaml_file.fileno())
+                os.replace(temporary_path, self.yaml_path)
+            except BaseException:
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+                raise
+            if folder_fd is not None:
+                # Persists the rename
+                os.fsync(folder_fd)
+        self.file_fingerprint = (yaml_stat.st_mtime_ns, yaml_stat.st_size, hashlib.sha256(yaml_bytes).hexdigest())
+
+    @contextlib.contextmanager
+    def _lock_folder(self):
+        # Takes an advisory lock shared by all the writers of the templates of this dataset. The folder itself is
+        # locked, as a lock file would be listed among the templates. Yields a file descriptor of the folder.
+        if fcntl is None:
+            yield None
+            return
+        folder_fd = os.open(self.folder_path, os.O_RDONLY)
+        try:
+            fcntl.flock(folder_fd, fcntl.LOCK_EX)
+            yield folder_fd
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(folder_fd)
+
+    def _check_file_version(self) -> None:
+        # Optimistic concurrency control: the file must not have changed since this object read or wrote it
+        if self.is_file_modified():
+            dataset_name = f"{self.dataset_name} {self.subset_name}" if self.subset_name else self.dataset_name
+            raise TemplatesFileConflictError(
+                f"The templates of {dataset_name} were modified by someone else since they were read. Load them "
+                "again, e.g. with TemplateCollection.refresh, before changing them."
+            )
+
+    def is_file_modified(self) -> bool:
+        """
+        Checks whether the YAML file changed since it was last read or written by this object, comparing its
+        modification time and size, and then its hash if they differ
+        """
+        signature = _get_file_signature(self.yaml_path)
+        if signature is None or self.file_fingerprint is None:
+            return signature != self.file_fingerprint
+        if signature == self.file_fingerprint[:2]:
+            return False
+        with open(self.yaml_path, "rb") as yaml_file:
+            yaml_hash = hashlib.sha256(yaml_file.read()).hexdigest()
+        if yaml_hash != self.file_fingerprint[2]:
+            return True
+        # The file was only touched
+        self.file_fingerprint = (*signature, yaml_hash)
+        return False
 
     def add_template(self, template: "Template") -> None:
         """
@@ -632,9 +1855,12 @@ class DatasetTemplates:
 
         :param template: template
         """
-        self.templates[template.get_id()] = template
-
-        self.write_to_file()
+        # The change is rolled back if it cannot be written, see batch
+        with self.batch():
+            self.templates[template.get_id()] = template
+            self.name_to_id_mapping[template.get_name()] = template.get_id()
+            self._has_pending_changes = True
+        self._notify("add", template)
 
     def remove_template(self, template_name: str) -> None:
         """
@@ -644,17 +1870,16 @@ class DatasetTemplates:
         """
 
         # Even if we have an ID, we want to check for duplicate names
-        if template_name not in self.all_template_names:
+        if template_name not in self.name_to_id_mapping:
             raise ValueError(f"No template with name {template_name} for dataset {self.dataset_name} exists.")
 
-        del self.templates[self.name_to_id_mapping[template_name]]
-
-        if len(self.templates) == 0:
-            # There is no remaining template, we can remove the entire folder
-            self.delete_folder()
-        else:
-            # We just update the file
-            self.write_to_file()
+        # The folder is removed along with the last template. The change is rolled back if it cannot be written.
+        with self.batch():
+            template_id = self.name_to_id_mapping.pop(template_name)
+            compiled_templates.invalidate(template_id)
+            template = self.templates.pop(template_id)
+            self._has_pending_changes = True
+        self._notify("remove", template)
 
     def update_template(
         self,
@@ -676,13 +1901,19 @@ class DatasetTemplates:
         :param answer_choices: new answer_choices string
         """
         template_id = self.name_to_id_mapping[current_template_name]
-        self.templates[template_id].name = new_template_name
-        self.templates[template_id].jinja = jinja
-        self.templates[template_id].reference = reference
-        self.templates[template_id].metadata = metadata
-        self.templates[template_id].answer_choices = answer_choices
-
-        self.write_to_file()
+        # The change is rolled back if it cannot be written, see batch
+        with self.batch():
+            # The compiled versions of the previous Jinja sources are no longer needed
+            compiled_templates.invalidate(template_id)
+            self.templates[template_id].name = new_template_name
+            self.templates[template_id].jinja = jinja
+            self.templates[template_id].reference = reference
+            self.templates[template_id].metadata = metadata
+            self.templates[template_id].answer_choices = answer_choices
+            del self.name_to_id_mapping[current_template_name]
+            self.name_to_id_mapping[new_template_name] = template_id
+            self._has_pending_changes = True
+        self._notify("update", self.templates[template_id])
 
     def delete_folder(self) -> None:
         """
@@ -690,7 +1921,9 @@ class DatasetTemplates:
         """
         self.sync_mapping()
 
-        rmtree(self.folder_path)
+        with self._lock_folder():
+            self._check_file_version()
+            rmtree(self.folder_path)
 
         # If it is a subset, we have to check whether to remove the dataset folder
         if self.subset_name:
@@ -699,6 +1932,60 @@ class DatasetTemplates:
             if len(os.listdir(base_dataset_folder)) == 0:
                 rmtree(base_dataset_folder)
 
+    def apply_batch(
+        self,
+        batch,
+        template_names: Optional[List[str]] = None,
+        indices=None,
+        truncate=False,
+        highlight_variables=False,
+        no_none=True,
+        seed=None,
+        split=None,
+    ) -> Dict[str, Dict]:
+        """
+        Applies templates of the dataset to a batch of examples in columnar format, see Template.apply_batch. Each
+        column referenced by the templates is escaped once for all of them, instead of once per template.
+
+        :param template_names: names of the templates to apply, defaults to all of them
+        :return: dictionary with key=template name and value=output of Template.apply_batch
+        """
+        if "answer_choices" in batch:
+            raise ValueError("Batch contains the restricted column 'answer_choices'.")
+
+        num_rows = len(next(iter(batch.values()))) if batch else 0
+        # Escaped columns, with key=(column, delimiter)
+        protected_columns = {}
+        outputs = {}
+        for template_name in template_names if template_names is not None else self.all_template_names:
+            template = self[template_name]
+            if isinstance(truncate, TruncationBudget):
+                # Fields are truncated differently for each template
+                outputs[template_name] = template.apply_batch(
+                    batch, indices, truncate, highlight_variables, no_none, seed, split
+                )
+                continue
+            for column in template.referenced_fields:
+                if column in batch and (column, template.delimeter) not in protected_columns:
+                    protected_columns[column, template.delimeter] = Template._escape_pipe_values(
+                        batch[column], template.delimeter
+                    )
+            outputs[template_name] = template._apply_protected_batch(
+                {
+                    column: protected_columns[column, template.delimeter]
+                    for column in template.referenced_fields
+                    if column in batch
+                },
+                num_rows,
+                indices,
+                truncate,
+                highlight_variables,
+                no_none,
+                seed,
+                split,
+            )
+        return outputs
+
     def __getitem__(self, template_key: str) -> "Template":
         return self.templates[self.name_to_id_mapping[template_key]]
 
@@ -706,42 +1993,294 @@ class DatasetTemplates:
         return len(self.templates)
 
 
-def get_templates_data_frame():
+class TemplatesPack:
     """
-    Gathers all template information into a Pandas DataFrame.
+    Single-file bundle of all the templates, loaded instead of the YAML files to skip parsing them.
 
-    :return: Pandas DataFrame
+    The file starts with PACK_MAGIC and the length of a pickled header, which maps each (dataset_name, subset_name)
+    to the position of its pickled templates after the header and to the SHA-256 hash of the templates.yaml file they
+    come from. The file is memory-mapped, so processes share its pages, and templates are only unpickled for the
+    datasets that are loaded and whose YAML file did not change since the pack was built.
     """
-    data = {
-        "id": [],
-        "dataset": [],
-        "subset": [],
-        "name": [],
-        "reference": [],
-        "original_task": [],
-        "choices_in_prompt": [],
-        "metrics": [],
-        "languages": [],
-        "answer_choices": [],
-        "jinja": [],
-    }
 
-    template_collection = TemplateCollection()
+    PACK_MAGIC = b"PSPACK1\n"
+    VERSION = 1
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as pack_file:
+            self._buffer = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._buffer[: len(self.PACK_MAGIC)] != self.PACK_MAGIC:
+            raise ValueError(f"{path} is not a templates pack.")
+        header_start = len(self.PACK_MAGIC) + 8
+        header_length = int.from_bytes(self._buffer[len(self.PACK_MAGIC) : header_start], "little")
+        header = pickle.loads(self._buffer[header_start : header_start + header_length])
+        if header["version"] != self.VERSION:
+            raise ValueError(f"{path} has version {header['version']}, expected {self.VERSION}.")
+        self.tree_hash: str = header["tree_hash"]
+        # Maps (dataset_name, subset_name) to (offset after the header, length, hash of the templates.yaml file)
+        self.entries: Dict[Tuple[str, Optional[str]], Tuple[int, int, str]] = header["entries"]
+        self._data_start = header_start + header_length
+
+    def load(self, dataset_name: str, subset_name: Optional[str], file_hash: str) -> Optional[Dict]:
+        """
+        Returns the templates of a dataset, as read by DatasetTemplates.read_from_file
+
+        :param dataset_name: name of the dataset
+        :param subset_name: name of the subset
+        :param file_hash: SHA-256 hash of the current templates.yaml file of the dataset
+        :return: dict of templates keyed by id, or None if the pack does not contain this version of the file
+        """
+        entry = self.entries.get((dataset_name, subset_name))
+        if entry is None or entry[2] != file_hash:
+            return None
+        start = self._data_start + entry[0]
+        templates, referenced_fields = pickle.loads(memoryview(self._buffer)[start : start + entry[1]])
+        for template_id, template in templates.items():
+            # Seeds the memoized analysis stored at build time
+            template._referenced_fields_memo = (
+                (template.jinja, template.answer_choices),
+                referenced_fields[template_id],
+            )
+        return templates
+
+    def is_up_to_date(self) -> bool:
+        """
+        Checks whether the pack was built from the current templates folder
+        """
+        return self.tree_hash == self.compute_tree_hash()[0]
+
+    @staticmethod
+    def compute_tree_hash() -> Tuple[str, Dict[Tuple[str, Optional[str]], str]]:
+        """
+        Hashes the content of the templates folder
+
+        :return: hash of the whole folder, and hash of the templates.yaml file of each (dataset_name, subset_name)
+        """
+        file_hashes = {}
+        tree_hash = hashlib.sha256()
+        for dataset_name, subset_name in TemplateCollection().keys:
+            yaml_path = DatasetTemplates.get_yaml_path(dataset_name, subset_name)
+            if not os.path.exists(yaml_path):
+                continue
+            with open(yaml_path, "rb") as yaml_file:
+                file_hash = hashlib.sha256(yaml_file.read()).hexdigest()
+            file_hashes[(dataset_name, subset_name)] = file_hash
+            tree_hash.update(f"{dataset_name}/{subset_name}:{file_hash}\n".encode("utf-8"))
+        return tree_hash.hexdigest(), file_hashes
+
+    @classmethod
+    def build(cls, path: Optional[str] = None) -> str:
+        """
+        Builds a pack from the YAML files of the templates folder
 
-    for key in template_collection.keys:
-        templates = template_collection.get_dataset(key[0], key[1])
+        :param path: path of the pack, defaults to get_templates_pack_path()
+        :return: hash of the templates folder the pack was built from
+        """
+        path = path or get_templates_pack_path()
+        tree_hash, file_hashes = cls.compute_tree_hash()
+
+        blobs = []
+        entries = {}
+        offset = 0
+        for (dataset_name, subset_name), file_hash in file_hashes.items():
+            yaml_path = DatasetTemplates.get_yaml_path(dataset_name, subset_name)
+            with open(yaml_path, "rb") as yaml_file:
+                yaml_bytes = yaml_file.read()
+            if hashlib.sha256(yaml_bytes).hexdigest() != file_hash:
+                raise ValueError(f"{yaml_path} changed while building the templates pack.")
+            templates = yaml.load(yaml_bytes, Loader=YAML_LOADER)[DatasetTemplates.TEMPLATES_KEY]
+            referenced_fields = {
+                template_id: template.referenced_fields for template_id, template in templates.items()
+            }
+            blob = pickle.dumps((templates, referenced_fields), protocol=pickle.HIGHEST_PROTOCOL)
+            entries[(dataset_name, subset_name)] = (offset, len(blob), file_hash)
+            blobs.append(blob)
+            offset += len(blob)
+
+        header = pickle.dumps(
+            {"version": cls.VERSION, "tree_hash": tree_hash, "entries": entries}, protocol=pickle.HIGHEST_PROTOCOL
+        )
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        with open(temporary_path, "wb") as pack_file:
+            pack_file.write(cls.PACK_MAGIC)
+            pack_file.write(len(header).to_bytes(8, "little"))
+            pack_file.write(header)
+            for blob in blobs:
+                pack_file.write(blob)
+        os.replace(temporary_path, path)
+        return tree_hash
+
+
+def get_templates_pack_path() -> str:
+    """
+    Returns the path of the templates pack, which can be overridden with the PROMPTSOURCE_TEMPLATES_PACK environment
+    variable
+    """
+    return os.environ.get(
+        "PROMPTSOURCE_TEMPLATES_PACK", os.path.join(DEFAULT_PROMPTSOURCE_CACHE_HOME, "templates.pack")
+    )
+
+
+def get_template_id_index_path() -> str:
+    """
+    Returns the path of the index used by TemplateCollection.get_by_id, which can be overridden with the
+    PROMPTSOURCE_TEMPLATE_ID_INDEX environment variable
+    """
+    return os.environ.get(
+        "PROMPTSOURCE_TEMPLATE_ID_INDEX", os.path.join(DEFAULT_PROMPTSOURCE_CACHE_HOME, "template_ids.index")
+    )
+
+
+# Templates pack opened by get_templates_pack, with the modification time of its file
+_templates_pack: Tuple[Optional[int], Optional[TemplatesPack]] = (None, None)
+
+
+def get_templates_pack() -> Optional[TemplatesPack]:
+    """
+    Returns the templates pack if it exists, opening it again if its file was rebuilt
+
+    :return: a TemplatesPack, or None
+    """
+    global _templates_pack
+    try:
+        mtime = os.stat(get_templates_pack_path()).st_mtime_ns
+    except OSError:
+        return None
+    if _templates_pack[0] != mtime:
+        try:
+            _templates_pack = (mtime, TemplatesPack(get_templates_pack_path()))
+        except (OSError, ValueError, pickle.UnpicklingError) as e:
+            logging.warning(f"Ignoring the templates pack {get_templates_pack_path()}: {e}")
+            _templates_pack = (mtime, None)
+    return _templates_pack[1]
+
+
+# Columns of the templates catalog, see get_templates_data_frame
+TEMPLATES_CATALOG_SCHEMA = pa.schema(
+    [
+        ("id", pa.string()),
+        ("dataset", pa.string()),
+        ("subset", pa.string()),
+        ("name", pa.string()),
+        ("reference", pa.string()),
+        ("original_task", pa.bool_()),
+        ("choices_in_prompt", pa.bool_()),
+        ("metrics", pa.list_(pa.string())),
+        ("languages", pa.list_(pa.string())),
+        ("answer_choices", pa.string()),
+        ("jinja", pa.string()),
+    ]
+)
+# Key of the Parquet metadata of the catalog holding the hashes of the YAML files it was built from
+TEMPLATES_CATALOG_METADATA_KEY = b"promptsource"
+TEMPLATES_CATALOG_VERSION = 1
+
+
+def get_templates_catalog_path() -> str:
+    """
+    Returns the path of the templates catalog, which can be overridden with the PROMPTSOURCE_TEMPLATES_CATALOG
+    environment variable
+    """
+    return os.environ.get(
+        "PROMPTSOURCE_TEMPLATES_CATALOG", os.path.join(DEFAULT_PROMPTSOURCE_CACHE_HOME, "templates_catalog.parquet")
+    )
+
+
+def _read_templates_catalog_hashes(path: str) -> Optional[Dict]:
+    # Hashes of the templates folder and of its YAML files the catalog was built from, or None if it is unusable
+    try:
+        metadata = json.loads(pq.read_schema(path).metadata[TEMPLATES_CATALOG_METADATA_KEY])
+    except (OSError, KeyError, TypeError, ValueError, pa.ArrowException):
+        return None
+    if metadata.get("version") != TEMPLATES_CATALOG_VERSION:
+        return None
+    return metadata
+
+
+def build_templates_catalog(path: Optional[str] = None, columns: Optional[List[str]] = None) -> pa.Table:
+    """
+    Brings the templates catalog up to date, only reading the YAML files that changed since it was built
+
+    :param path: path of the catalog, defaults to get_templates_catalog_path()
+    :param columns: columns to return, among the names of TEMPLATES_CATALOG_SCHEMA, defaults to all of them
+    :return: the catalog, as a pyarrow Table
+    """
+    path = path or get_templates_catalog_path()
+    tree_hash, file_hashes = TemplatesPack.compute_tree_hash()
+    metadata = _read_templates_catalog_hashes(path)
+    if metadata is not None and metadata["tree_hash"] == tree_hash:
+        # Only the requested columns are read from the file
+        return pq.read_table(path, columns=columns)
+
+    # Rows of the previous catalog, for the datasets whose file did not change
+    previous_rows = defaultdict(list)
+    if metadata is not None:
+        previous_hashes = {
+            (dataset_name, subset_name): file_hash for dataset_name, subset_name, file_hash in metadata["file_hashes"]
+        }
+        for row in pq.read_table(path).to_pylist():
+            key = (row["dataset"], row["subset"])
+            if previous_hashes.get(key) == file_hashes.get(key):
+                previous_rows[key].append(row)
+
+    rows = []
+    for key in file_hashes:
+        if key in previous_rows:
+            rows.extend(previous_rows[key])
+            continue
+        templates = DatasetTemplates(*key)
         for template_name in templates.all_template_names:
             template = templates[template_name]
-            data["id"].append(template.get_id())
-            data["dataset"].append(key[0])
-            data["subset"].append(key[1])
-            data["name"].append(template.get_name())
-            data["reference"].append(template.get_reference())
-            data["original_task"].append(template.metadata.original_task)
-            data["choices_in_prompt"].append(template.metadata.choices_in_prompt)
-            data["metrics"].append(template.metadata.metrics)
-            data["languages"].append(template.metadata.languages)
-            data["answer_choices"].append(template.get_answer_choices_expr())
-            data["jinja"].append(template.jinja)
-
-    return pd.DataFrame(data)
+            rows.append(
+                {
+                    "id": template.get_id(),
+                    "dataset": key[0],
+                    "subset": key[1],
+                    "name": template.get_name(),
+                    "reference": template.get_reference(),
+                    "original_task": template.metadata.original_task,
+                    "choices_in_prompt": template.metadata.choices_in_prompt,
+                    "metrics": template.metadata.metrics,
+                    "languages": template.metadata.languages,
+                    "answer_choices": template.get_answer_choices_expr(),
+                    "jinja": template.jinja,
+                }
+            )
+    hashes = {
+        "version": TEMPLATES_CATALOG_VERSION,
+        "tree_hash": tree_hash,
+        "file_hashes": [[key[0], key[1], file_hash] for key, file_hash in file_hashes.items()],
+    }
+    table = pa.Table.from_pylist(rows, schema=TEMPLATES_CATALOG_SCHEMA).replace_schema_metadata(
+        {TEMPLATES_CATALOG_METADATA_KEY: json.dumps(hashes)}
+    )
+
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        temporary_path = f"{path}.{os.getpid()}.tmp"
+        pq.write_table(table, temporary_path)
+        os.replace(temporary_path, path)
+    except OSError as e:
+        logging.warning(f"Could not save the templates catalog to {path}: {e}")
+    return table if columns is None else table.select(columns)
+
+
+def get_templates_data_frame(columns: Optional[List[str]] = None):
+    """
+    Gathers all template information into a Pandas DataFrame.
+
+    The information is read from a catalog cached in a Parquet file, see build_templates_catalog. When it is up to
+    date, only the requested columns are read from it.
+
+    :param columns: columns to load, among the names of TEMPLATES_CATALOG_SCHEMA, defaults to all of them
+    :return: Pandas DataFrame
+    """
+    data_frame = build_templates_catalog(columns=columns).to_pandas()
+    # Lists are returned as such, rather than as numpy arrays
+    for column in ["metrics", "languages"]:
+        if column in data_frame:
+            data_frame[column] = [None if value is None else list(value) for value in data_frame[column]]
+    return data_frame
@@ -0,0 +1,27 @@
+import argparse
+import time
+
+from promptsource.templates import TemplatesPack, get_templates_pack_path
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Bundles all the templates into a single pack file, which is then loaded instead of the YAML "
+        "files that did not change since it was built."
+    )
+    parser.add_argument(
+        "--output-path",
+        type=str,
+        default=get_templates_pack_path(),
+        help="Path of the pack. Processes look for it in ~/.cache/promptsource/templates.pack, or in the path given "
+        "by the PROMPTSOURCE_TEMPLATES_PACK environment variable.",
+    )
+    args = parser.parse_args()
+
+    start = time.time()
+    tree_hash = TemplatesPack.build(args.output_path)
+    print("Built {} (templates hash {}) in {:.1f}s.".format(args.output_path, tree_hash, time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
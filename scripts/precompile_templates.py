@@ -0,0 +1,49 @@
+import argparse
+import itertools
+import time
+
+from promptsource.templates import BYTECODE_CACHE_DIR, TemplateCollection, enable_bytecode_cache, precompile_templates
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Fills the persistent cache of compiled templates ahead of a large job. Processes of the job then "
+        "reuse it when the PROMPTSOURCE_BYTECODE_CACHE environment variable is set (to 1 for the default cache dir)."
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=BYTECODE_CACHE_DIR,
+        help="Path to the cache dir of the compiled templates.",
+    )
+    parser.add_argument(
+        "--all-options",
+        action="store_true",
+        help="Compile the templates for every combination of the `truncate`, `highlight_variables` and `no_none` "
+        "options of `Template.apply`, instead of only for the default ones.",
+    )
+    args = parser.parse_args()
+
+    enable_bytecode_cache(args.cache_dir)
+    if args.all_options:
+        option_sets = list(itertools.product([False, True], repeat=3))
+    else:
+        option_sets = [(False, False, True)]
+
+    start = time.time()
+    template_collection = TemplateCollection()
+    templates = [
+        template
+        for key in template_collection.keys
+        for template in template_collection.get_dataset(*key).templates.values()
+    ]
+    count = precompile_templates(templates, option_sets)
+    print(
+        "Compiled {} templates ({} option sets) into {} in {:.1f}s.".format(
+            count, len(option_sets), args.cache_dir, time.time() - start
+        )
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,104 +1,882 @@
 import os
+import glob
+import gzip
 import json
+import lzma
+import time
+import hashlib
+import queue
+import itertools
+import threading
+import contextlib
+from collections import defaultdict
 import argparse
 import datasets
+import pyarrow as pa
+import pyarrow.parquet as pq
 from tqdm import tqdm
 import concurrent.futures
 from promptsource.templates import DatasetTemplates
 
 
-def export_dataset(
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+# Default maximum number of examples of a split rendered by a single task
+DEFAULT_SHARD_SIZE = 500000
+# Number of rows read from a split, or written to an output file, at once
+WRITE_BATCH_SIZE = 1000
+# Maximum number of batches read from a streamed split ahead of their rendering
+STREAM_BUFFER_SIZE = 8
+
+# Columns of the Parquet and Arrow outputs, where the metadata of the rows, the same for all the rows of a file, are
+# dictionary-encoded
+PROMPTED_ROW_SCHEMA = pa.schema(
+    [
+        ("id", pa.int64()),
+        ("source", pa.string()),
+        ("target", pa.string()),
+        ("answer_choices", pa.list_(pa.string())),
+        ("prompt_template", pa.dictionary(pa.int32(), pa.string())),
+        ("prompt_name", pa.dictionary(pa.int32(), pa.string())),
+        ("dataset_name", pa.dictionary(pa.int32(), pa.string())),
+        ("subset_name", pa.dictionary(pa.int32(), pa.string())),
+        ("split", pa.dictionary(pa.int32(), pa.string())),
+    ]
+)
+
+
+def share_dataset(dataset, cache_dir):
+    """
+    Describes each split of a DatasetDict by the Arrow files backing it, so that tasks only ship these paths to the
+    workers, which memory-map the files with `open_shared_split` and share their pages, instead of each receiving a
+    pickled copy of the dataset. Splits that are held in memory, or that are not exactly the content of their files
+    (e.g. after a `select` or a `rename_column`), are first written to a single Arrow file in the cache dir.
+    """
+    shared_dataset = {}
+    for split, dataset_split in dataset.items():
+        shared_split = [cache_file["filename"] for cache_file in dataset_split.cache_files]
+        if not shared_split or not _is_shared_split_of(shared_split, dataset_split):
+            cache_file_name = os.path.join(cache_dir, "shared-{}-{}.arrow".format(dataset_split._fingerprint, split))
+            dataset_split = dataset_split.flatten_indices(cache_file_name=cache_file_name)
+            shared_split = [cache_file_name]
+        shared_dataset[split] = shared_split
+    return shared_dataset
+
+
+def open_shared_split(shared_split):
+    # Memory-maps a split described by `share_dataset`
+    dataset_splits = [datasets.Dataset.from_file(filename) for filename in shared_split]
+    if len(dataset_splits) == 1:
+        return dataset_splits[0]
+    return datasets.concatenate_datasets(dataset_splits)
+
+
+def _is_shared_split_of(shared_split, dataset_split):
+    if dataset_split._indices is not None:
+        return False
+    opened_split = open_shared_split(shared_split)
+    return opened_split.num_rows == dataset_split.num_rows and opened_split.features == dataset_split.features
+
+
+def _dumps_json(obj):
+    return json.dumps(obj).encode("utf-8")
+
+
+def _dumps_orjson(obj):
+    return orjson.dumps(obj)
+
+
+# Serializers of the rows, from dicts to UTF-8 JSON
+SERIALIZERS = {"json": _dumps_json}
+if orjson is not None:
+    SERIALIZERS["orjson"] = _dumps_orjson
+
+# Extensions of the output files, and streaming compressors wrapping the files they write to
+COMPRESSIONS = {
+    None: ("", lambda file_ptr: file_ptr),
+    # mtime=0 so that a shard always gets the same bytes, and checksum
+    "gzip": (".gz", lambda file_ptr: gzip.GzipFile(filename="", mode="wb", fileobj=file_ptr, mtime=0)),
+    "xz": (".xz", lambda file_ptr: lzma.LZMAFile(file_ptr, "wb")),
+    "zstd": (".zst", lambda file_ptr: zstandard.ZstdCompressor().stream_writer(file_ptr, closefd=False)),
+}
+
+
+class _HashingFile:
+    # Binary file computing the size and the checksum of what is written to it, as they are written
+    def __init__(self, path):
+        self._file_ptr = open(path, "wb")
+        self.sha256 = hashlib.sha256()
+        self.num_bytes = 0
+
+    def write(self, data):
+        self.sha256.update(data)
+        self.num_bytes += len(data)
+        return self._file_ptr.write(data)
+
+    def flush(self):
+        self._file_ptr.flush()
+
+    def tell(self):
+        return self.num_bytes
+
+    @property
+    def closed(self):
+        return self._file_ptr.closed
+
+    def close(self, sync=False):
+        try:
+            if sync:
+                self._file_ptr.flush()
+                os.fsync(self._file_ptr.fileno())
+        finally:
+            self._file_ptr.close()
+
+
+class ShardWriter:
+    """
+    Writes the rows of an output file so that it is either complete or absent: rows are written to a temporary file,
+    which replaces the output file once complete, and is followed by a manifest recording the number of rows, the size
+    and the checksum of the file, with which `is_shard_complete` tells the shards that do not need to be exported
+    again.
+
+    Rows are written batch by batch. With `max_file_size`, the output is rolled over files named
+    `<file>-part-<index>.<extension>` of about this size on disk, all described by the manifest. Subclasses encode the
+    batches in an output format, see OUTPUT_FORMATS.
+
+    :param manifest: description of the task writing the file, stored in the manifest
+    """
+
+    # Extension of the output files, before the one of their compression if any
+    extension = None
+
+    def __init__(self, path, manifest=None, max_file_size=None):
+        self.path = path
+        self.manifest = dict(manifest or {})
+        self.max_file_size = max_file_size
+        self.num_rows = 0
+        self._files = []
+        self._raw_file_ptr = None
+
+    def __enter__(self):
+        # The manifest of a previous export must never describe the new files
+        manifest_path = get_manifest_path(self.path)
+        if os.path.exists(manifest_path):
+            os.remove(manifest_path)
+        # Files of a previous export, which may have been rolled over more files, or interrupted, are removed so that
+        # they are not mistaken for files of the new one
+        stem, compression_extension = self.path.rsplit(self.extension, 1)
+        part_pattern = "{}-part-{}{}{}".format(
+            glob.escape(stem), "[0-9]" * 5, glob.escape(self.extension), glob.escape(compression_extension)
+        )
+        for path in [self.path, *glob.glob(part_pattern), *glob.glob(part_pattern + ".tmp")]:
+            if os.path.exists(path):
+                os.remove(path)
+        return self
+
+    def write_batch(self, batch, metadata):
+        """
+        Writes a batch of rendered rows, in columnar format with the "id", "source", "target" and "answer_choices"
+        columns, along with the metadata of the output, the same for all its rows
+        """
+        raise NotImplementedError
+
+    def _open_file(self, metadata):
+        # Opens the next file of the output, with `metadata` None when the output has no row
+        path = self.path
+        if self.max_file_size is not None:
+            stem, compression_extension = self.path.rsplit(self.extension, 1)
+            path = "{}-part-{:05d}{}{}".format(stem, len(self._files), self.extension, compression_extension)
+        self._files.append({"path": path, "rows": 0})
+        self._raw_file_ptr = _HashingFile(path + ".tmp")
+
+    def _close_encoder(self):
+        # Writes what the encoder of the current file still buffers
+        pass
+
+    def _add_rows(self, num_rows):
+        self._files[-1]["rows"] += num_rows
+        self.num_rows += num_rows
+        if self.max_file_size is not None and self._raw_file_ptr.num_bytes >= self.max_file_size:
+            self._close_file()
+
+    def _close_file(self):
+        self._close_encoder()
+        raw_file_ptr = self._raw_file_ptr
+        raw_file_ptr.close(sync=True)
+        self._raw_file_ptr = None
+        path = self._files[-1]["path"]
+        os.replace(path + ".tmp", path)
+        self._files[-1].update(
+            path=os.path.basename(path), bytes=raw_file_ptr.num_bytes, sha256=raw_file_ptr.sha256.hexdigest()
+        )
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            if self._raw_file_ptr is not None:
+                with contextlib.suppress(Exception):
+                    self._raw_file_ptr.close()
+                os.remove(self._files[-1]["path"] + ".tmp")
+            return
+        if not self._files:
+            # Empty splits still get an output file, without any row
+            self._open_file(None)
+        if self._raw_file_ptr is not None:
+            self._close_file()
+        self.manifest.update(rows=self.num_rows, files=self._files)
+        manifest_path = get_manifest_path(self.path)
+        with open(manifest_path + ".tmp", "w", encoding="utf-8") as file_ptr:
+            json.dump(self.manifest, file_ptr, indent=2, sort_keys=True)
+            file_ptr.flush()
+            os.fsync(file_ptr.fileno())
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+
+class JsonlShardWriter(ShardWriter):
+    """
+    Writes rows in JSONL, serialized batch by batch and through a streaming compressor if any. With `metadata_header`,
+    the metadata that is the same for all the rows is written once, as the first line `{"header": {...}}` of each
+    file, instead of in every row. Answer choices are not written.
+
+    :param compression: None, or one of COMPRESSIONS
+    :param serializer: one of SERIALIZERS
+    """
+
+    extension = ".jsonl"
+
+    def __init__(
+        self, path, manifest=None, max_file_size=None, compression=None, serializer="json", metadata_header=False
+    ):
+        super().__init__(path, manifest, max_file_size)
+        if compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression {}, expected one of {}".format(compression, list(COMPRESSIONS)))
+        if compression == "zstd" and zstandard is None:
+            raise ImportError("The zstd compression requires the zstandard package: pip install zstandard")
+        if serializer not in SERIALIZERS:
+            raise ValueError("Unavailable serializer {}, expected one of {}".format(serializer, list(SERIALIZERS)))
+        self.compression = compression
+        self.serialize = SERIALIZERS[serializer]
+        self.metadata_header = metadata_header
+        self._file_ptr = None
+
+    def write_batch(self, batch, metadata):
+        row_metadata = {} if self.metadata_header else metadata
+        lines = [
+            self.serialize({"id": _id, "source": source, "target": target, **row_metadata}) + b"\n"
+            for _id, source, target in zip(batch["id"], batch["source"], batch["target"])
+        ]
+        if self._raw_file_ptr is None:
+            self._open_file(metadata)
+        if self.max_file_size is None:
+            self._file_ptr.write(b"".join(lines))
+            self._add_rows(len(lines))
+            return
+        for line in lines:
+            if self._raw_file_ptr is None:
+                self._open_file(metadata)
+            self._file_ptr.write(line)
+            self._add_rows(1)
+
+    def _open_file(self, metadata):
+        super()._open_file(metadata)
+        self._file_ptr = COMPRESSIONS[self.compression][1](self._raw_file_ptr)
+        if self.metadata_header and metadata is not None:
+            self._file_ptr.write(self.serialize({"header": metadata}) + b"\n")
+
+    def _close_encoder(self):
+        file_ptr, self._file_ptr = self._file_ptr, None
+        if file_ptr is not self._raw_file_ptr:
+            file_ptr.close()
+
+
+class ArrowShardWriter(ShardWriter):
+    """
+    Writes rows in the Arrow IPC streaming format, as do the Arrow files of the `datasets` library, so that outputs
+    can be memory-mapped with `datasets.Dataset.from_file`. The metadata columns are dictionary-encoded, so that they
+    are stored once per batch.
+
+    :param compression: None, or one of ArrowShardWriter.compressions, the codec of the buffers
+    :param kwargs: options of the other output formats, e.g. the serializer of JSONL outputs, which are ignored
+    """
+
+    extension = ".arrow"
+    compressions = [None, "zstd"]
+
+    def __init__(self, path, manifest=None, max_file_size=None, compression=None, **kwargs):
+        super().__init__(path, manifest, max_file_size)
+        if compression not in self.compressions:
+            raise ValueError(
+                "Unsupported compression {} for {} outputs, expected one of {}".format(
+                    compression, self.extension, self.compressions
+                )
+            )
+        self.compression = compression
+        self._writer = None
+
+    def write_batch(self, batch, metadata):
+        if self._raw_file_ptr is None:
+            self._open_file(metadata)
+        num_rows = len(batch["id"])
+        columns = [
+            pa.array(batch["id"], PROMPTED_ROW_SCHEMA.field("id").type),
+            pa.array(batch["source"], pa.string()),
+            pa.array(batch["target"], pa.string()),
+            pa.array(batch["answer_choices"], PROMPTED_ROW_SCHEMA.field("answer_choices").type),
+        ]
+        for name in PROMPTED_ROW_SCHEMA.names[len(columns) :]:
+            if metadata[name] is None:
+                indices, dictionary = pa.nulls(num_rows, pa.int32()), []
+            else:
+                indices, dictionary = pa.array([0] * num_rows, pa.int32()), [metadata[name]]
+            columns.append(pa.DictionaryArray.from_arrays(indices, pa.array(dictionary, pa.string())))
+        self._writer.write_table(pa.Table.from_arrays(columns, schema=PROMPTED_ROW_SCHEMA))
+        self._add_rows(num_rows)
+
+    def _open_file(self, metadata):
+        super()._open_file(metadata)
+        self._writer = pa.ipc.new_stream(
+            self._raw_file_ptr, PROMPTED_ROW_SCHEMA, options=pa.ipc.IpcWriteOptions(compression=self.compression)
+        )
+
+    def _close_encoder(self):
+        writer, self._writer = self._writer, None
+        writer.close()
+
+
+class ParquetShardWriter(ArrowShardWriter):
+    """
+    Writes rows in Parquet, with a row group per batch, and the metadata columns dictionary-encoded.
+
+    :param compression: None for the default codec of pyarrow, or one of ParquetShardWriter.compressions
+    """
+
+    extension = ".parquet"
+    compressions = [None, "gzip", "zstd"]
+
+    def _open_file(self, metadata):
+        ShardWriter._open_file(self, metadata)
+        self._writer = pq.ParquetWriter(
+            self._raw_file_ptr, PROMPTED_ROW_SCHEMA, compression=self.compression or "snappy", use_dictionary=True
+        )
+
+
+# Writers of the output files by output format
+OUTPUT_FORMATS = {
+    "jsonl": JsonlShardWriter,
+    "parquet": ParquetShardWriter,
+    "arrow": ArrowShardWriter,
+}
+
+
+def get_shard_writer(path, manifest=None, output_format="jsonl", **kwargs):
+    """
+    Returns the ShardWriter of an output file in the given format
+
+    :param kwargs: keyword arguments of the writer of the format, e.g. its compression
+    """
+    return OUTPUT_FORMATS[output_format](path, manifest, **kwargs)
+
+
+def get_manifest_path(path):
+    return path + ".manifest.json"
+
+
+def get_file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file_ptr:
+        for block in iter(lambda: file_ptr.read(1 << 20), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+
+def is_shard_complete(path, manifest):
+    """
+    Whether the files of an output were completely written by a task described by `manifest`, and were not modified
+    since, see ShardWriter
+    """
+    try:
+        with open(get_manifest_path(path), encoding="utf-8") as file_ptr:
+            written_manifest = json.load(file_ptr)
+        if any(written_manifest.get(key) != value for key, value in manifest.items()):
+            return False
+        for written_file in written_manifest["files"]:
+            file_path = os.path.join(os.path.dirname(path), written_file["path"])
+            if os.path.getsize(file_path) != written_file["bytes"]:
+                return False
+            if get_file_sha256(file_path) != written_file["sha256"]:
+                return False
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+    return True
+
+
+def get_output_path(
     dataset_output_dir,
+    split,
+    prompt_template,
+    prompt_name,
+    shard_index=0,
+    num_shards=1,
+    compression=None,
+    output_format="jsonl",
+):
+    output_path = os.path.join(dataset_output_dir, split)
+    os.makedirs(output_path, exist_ok=True)
+    file_name = (prompt_template + "." + prompt_name).replace("/", "_").replace(" ", "_")
+    if num_shards > 1:
+        file_name += "-{:05d}-of-{:05d}".format(shard_index, num_shards)
+    if output_format != "jsonl":
+        # Parquet and Arrow outputs are compressed inside the files
+        return os.path.join(output_path, file_name + OUTPUT_FORMATS[output_format].extension)
+    return os.path.join(output_path, file_name + ".jsonl" + COMPRESSIONS[compression][0])
+
+
+def export_split(
+    json_data_path,
     dataset_name,
     subset_name,
     prompt_template,
     prompt,
-    dataset,
+    split,
+    dataset_split,
+    offset=0,
+    seed=None,
+    manifest=None,
+    output_options=None,
 ):
-    splits = list(dataset.keys())
+    """
+    Renders the rows of a split with a prompt and writes them in an output file, in the format given by
+    `output_options`, see OUTPUT_FORMATS
+
+    :param offset: index of the first row of `dataset_split` in the whole split, when it is a shard of it
+    :param manifest: description of the export stored in the manifest of the file, see ShardWriter
+    :param output_options: keyword arguments of get_shard_writer, e.g. the output format and its compression
+    :return: number of rows written
+    """
     prompt_name = prompt.get_name()
-    for split in splits:
-        dataset_split = dataset[split]
-        json_data_path = os.path.join(dataset_output_dir, split)
-        os.makedirs(json_data_path, exist_ok=True)
-        json_data_path = os.path.join(
-            json_data_path,
-            (prompt_template + "." + prompt_name).replace("/", "_").replace(" ", "_")
-            + ".jsonl",
-        )
-        with open(json_data_path, "w", encoding="utf-8") as file_ptr:
-            total_num_sample = len(dataset_split)
-            for _id, sample in tqdm(
-                enumerate(dataset_split),
-                total=total_num_sample,
-                desc="{}_{}_{}_{}_{}".format(
-                    dataset_name, subset_name, split, prompt_template, prompt_name
-                ),
-            ):
-                projected_sample = prompt.apply(sample)
-                if len(projected_sample) != 2:
-                    continue
-                source, target = projected_sample
-                projected_sample_with_metadata = {
-                    "id": _id,
-                    "source": source,
-                    "target": target,
-                    "prompt_template": prompt_template,
-                    "prompt_name": prompt_name,
-                    "dataset_name": dataset_name,
-                    "subset_name": subset_name,
-                    "split": split,
-                }
-                file_ptr.write(json.dumps(projected_sample_with_metadata))
-                file_ptr.write("\n")
-    return "Completed:: {}!".format(json_data_path)
+    num_rows = 0
+    with get_shard_writer(json_data_path, manifest, **(output_options or {})) as file_ptr:
+        batch_start = offset
+        for batch in iter_dataset_batches(dataset_split):
+            batch_end = batch_start + len(next(iter(batch.values())))
+            # Rows that could not be rendered have a None source. With a seed, random choices in the prompt only
+            # depend on the seed, the prompt, the split and the row index.
+            batch = prompt.apply_batch(batch, range(batch_start, batch_end), seed=seed, split=split)
+            num_rows += write_prompted_rows(
+                file_ptr,
+                batch_start,
+                batch,
+                prompt_template,
+                prompt_name,
+                dataset_name,
+                subset_name,
+                split,
+            )
+            batch_start = batch_end
+    return num_rows
 
 
-def project_prompt_dataset(
-    raw_output_dir, dataset_name, subset_name, prompt_template, cache_dir, square_root_num_proc=1
+def write_prompted_rows(
+    file_ptr, first_id, prompted_batch, prompt_template, prompt_name, dataset_name, subset_name, split
+):
+    """
+    Writes a batch of rendered rows with a ShardWriter, skipping the rows that could not be rendered
+
+    :return: number of rows written
+    """
+    rendered_indices = [index for index, source in enumerate(prompted_batch["source"]) if source is not None]
+    projected_batch = {"id": [first_id + index for index in rendered_indices]}
+    for column in ["source", "target", "answer_choices"]:
+        projected_batch[column] = [prompted_batch[column][index] for index in rendered_indices]
+    metadata = {
+        "prompt_template": prompt_template,
+        "prompt_name": prompt_name,
+        "dataset_name": dataset_name,
+        "subset_name": subset_name,
+        "split": split,
+    }
+    file_ptr.write_batch(projected_batch, metadata)
+    return len(rendered_indices)
+
+
+def export_split_all_prompts(
+    json_data_paths,
+    dataset_name,
+    subset_name,
+    prompt_template,
+    prompts,
+    split,
+    batches,
+    offset=0,
+    seed=None,
+    manifests=None,
+    output_options=None,
 ):
-    dataset = datasets.load_dataset(dataset_name, subset_name, cache_dir=cache_dir)
+    """
+    Renders the rows of a split with several prompts, reading and escaping each row once for all of them, and writes
+    the rows rendered by each prompt in its own output file, in the format given by `output_options`, see
+    OUTPUT_FORMATS
+
+    :param json_data_paths: dict with key=prompt name and value=path of its output file
+    :param prompts: DatasetTemplates of the prompts
+    :param batches: iterable over the consecutive batches of rows of the split, in columnar format
+    :param manifests: dict with key=prompt name and value=description of the export stored in the manifest of its
+        output file, see ShardWriter
+    :param output_options: keyword arguments of get_shard_writer, e.g. the output format and its compression
+    :return: dict with key=prompt name and value=number of rows written
+    """
+    num_rows = dict.fromkeys(json_data_paths, 0)
+    manifests = manifests or {}
+    with contextlib.ExitStack() as stack:
+        file_ptrs = {
+            prompt_name: stack.enter_context(
+                get_shard_writer(json_data_path, manifests.get(prompt_name), **(output_options or {}))
+            )
+            for prompt_name, json_data_path in json_data_paths.items()
+        }
+        batch_start = offset
+        for batch in batches:
+            batch_end = batch_start + len(next(iter(batch.values())))
+            prompted_batches = prompts.apply_batch(
+                batch,
+                list(json_data_paths),
+                indices=range(batch_start, batch_end),
+                seed=seed,
+                split=split,
+            )
+            for prompt_name, prompted_batch in prompted_batches.items():
+                num_rows[prompt_name] += write_prompted_rows(
+                    file_ptrs[prompt_name],
+                    batch_start,
+                    prompted_batch,
+                    prompt_template,
+                    prompt_name,
+                    dataset_name,
+                    subset_name,
+                    split,
+                )
+            batch_start = batch_end
+    return num_rows
+
+
+def iter_dataset_batches(dataset_split):
+    # Batches of rows of a Dataset, in columnar format
+    for batch_start in range(0, dataset_split.num_rows, WRITE_BATCH_SIZE):
+        yield dataset_split[batch_start : batch_start + WRITE_BATCH_SIZE]
+
+
+def iter_stream_batches(iterable_split, buffer_size=STREAM_BUFFER_SIZE):
+    """
+    Batches of rows of an IterableDataset, in columnar format. Rows are read in a background thread, which waits when
+    `buffer_size` batches are waiting to be rendered, so that memory stays bounded whatever the size of the split.
+    """
+    buffer = queue.Queue(maxsize=buffer_size)
+    stopped = threading.Event()
+
+    def put(item):
+        # Waits for room in the buffer, unless the consumer stopped
+        while not stopped.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def read():
+        try:
+            rows = iter(iterable_split)
+            while True:
+                chunk = list(itertools.islice(rows, WRITE_BATCH_SIZE))
+                if not chunk:
+                    break
+                if not put({column: [row[column] for row in chunk] for column in chunk[0]}):
+                    return
+            put(None)
+        except Exception as e:
+            put(e)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        while True:
+            batch = buffer.get()
+            if batch is None:
+                return
+            if isinstance(batch, Exception):
+                raise batch
+            yield batch
+    finally:
+        stopped.set()
+
+
+def load_job(raw_output_dir, dataset_name, subset_name, prompt_template, cache_dir, data_files=None, streaming=False):
+    """
+    Loads the dataset of an export job, and returns what is needed to plan its tasks, see plan_tasks
+
+    :param data_files: data files of the dataset, e.g. for the packaged "json" or "parquet" datasets
+    :param streaming: if True, the dataset is streamed when exporting it instead of being downloaded and prepared first
+    """
+    dataset = datasets.load_dataset(
+        dataset_name, subset_name, cache_dir=cache_dir, data_files=data_files, streaming=streaming
+    )
     if prompt_template is None:
         if subset_name is None:
             prompt_template = "{}".format(dataset_name)
         else:
             prompt_template = "{}/{}".format(dataset_name, subset_name)
     dataset_output_dir = os.path.join(raw_output_dir, dataset_name)
-    os.makedirs(dataset_output_dir, exist_ok=True)
     if subset_name is not None:
         dataset_output_dir = os.path.join(dataset_output_dir, subset_name)
-        os.makedirs(dataset_output_dir, exist_ok=True)
-
-    prompts = DatasetTemplates(prompt_template)
-    prompt_names = list(prompts.name_to_id_mapping.keys())
-    # for prompt_name in prompt_names:
-    #     prompt = prompts[prompt_name]
-    #     export_dataset(
-    #         dataset_output_dir,
-    #         dataset_name,
-    #         subset_name,
-    #         prompt_template,
-    #         prompt,
-    #         dataset,
-    #     )
-    total_num_prompts = len(prompt_names)
+    os.makedirs(dataset_output_dir, exist_ok=True)
+    job = {
+        "dataset_output_dir": dataset_output_dir,
+        "dataset_name": dataset_name,
+        "subset_name": subset_name,
+        "prompt_template": prompt_template,
+    }
+    if streaming:
+        # An IterableDatasetDict only describes how to read the data, and is sent as is to the workers
+        job["streamed_dataset"] = dataset
+    else:
+        job["shared_dataset"] = share_dataset(dataset, cache_dir)
+        # Example counts of the splits, from the dataset infos
+        job["num_examples"] = {split: dataset_split.num_rows for split, dataset_split in dataset.items()}
+    return job
+
+
+def plan_tasks(jobs, shard_size, seed=None, example_major=False, resume=False, output_options=None):
+    """
+    Expands export jobs into (dataset, subset, split, prompt, row range) tasks, splitting each split into shards of
+    at most `shard_size` examples, and orders them longest first so that the last tasks to finish are short ones.
+    With `example_major`, a task renders its row range with all the prompts of the dataset instead of a single one.
+    With `resume`, tasks whose output files are already complete, see is_shard_complete, are skipped by the workers.
+    `output_options` are the keyword arguments of get_shard_writer for the outputs of the tasks, e.g. their format.
+    """
+    output_options = output_options or {}
+    compression = output_options.get("compression")
+    output_format = output_options.get("output_format", "jsonl")
+    tasks = []
+    for job in jobs:
+        prompts = DatasetTemplates(job["prompt_template"])
+        if "streamed_dataset" in job:
+            # The size of streamed splits is unknown, and each of them is read once for all the prompts
+            for split, iterable_split in job["streamed_dataset"].items():
+                json_data_paths = {
+                    prompt_name: get_output_path(
+                        job["dataset_output_dir"],
+                        split,
+                        job["prompt_template"],
+                        prompt_name,
+                        compression=compression,
+                        output_format=output_format,
+                    )
+                    for prompt_name in prompts.name_to_id_mapping
+                }
+                task = {
+                    "dataset_name": job["dataset_name"],
+                    "subset_name": job["subset_name"],
+                    "prompt_template": job["prompt_template"],
+                    "split": split,
+                    "iterable_split": iterable_split,
+                    "json_data_paths": json_data_paths,
+                    "prompts": prompts,
+                    "start": 0,
+                    "end": None,
+                    "seed": seed,
+                    "resume": resume,
+                    "output_options": output_options,
+                }
+                tasks.append(task)
+            continue
+        prompt_groups = [list(prompts.name_to_id_mapping)]
+        if not example_major:
+            prompt_groups = [[prompt_name] for prompt_name in prompt_groups[0]]
+        for prompt_names in prompt_groups:
+            for split, num_examples in job["num_examples"].items():
+                num_shards = max(1, -(-num_examples // shard_size))
+                for shard_index in range(num_shards):
+                    json_data_paths = {
+                        prompt_name: get_output_path(
+                            job["dataset_output_dir"],
+                            split,
+                            job["prompt_template"],
+                            prompt_name,
+                            shard_index,
+                            num_shards,
+                            compression,
+                            output_format,
+                        )
+                        for prompt_name in prompt_names
+                    }
+                    task = {
+                        "dataset_name": job["dataset_name"],
+                        "subset_name": job["subset_name"],
+                        "prompt_template": job["prompt_template"],
+                        "split": split,
+                        "shared_split": job["shared_dataset"][split],
+                        "start": num_examples * shard_index // num_shards,
+                        "end": num_examples * (shard_index + 1) // num_shards,
+                        "seed": seed,
+                        "resume": resume,
+                        "output_options": output_options,
+                    }
+                    if example_major:
+                        task.update(json_data_paths=json_data_paths, prompts=prompts)
+                    else:
+                        task.update(json_data_path=json_data_paths[prompt_names[0]], prompt=prompts[prompt_names[0]])
+                    tasks.append(task)
+    tasks.sort(key=get_task_cost, reverse=True)
+    return tasks
+
+
+def get_task_cost(task):
+    # Number of rows rendered by a task, where streamed splits of unknown sizes come first
+    if "iterable_split" in task:
+        return float("inf")
+    return (task["end"] - task["start"]) * len(task.get("json_data_paths", [None]))
+
+
+def get_task_manifests(task):
+    """
+    Describes the export of each output file of a task, as stored in their manifests
+
+    :return: dict with key=output path and value=its manifest
+    """
+    json_data_paths = task.get("json_data_paths") or {task["prompt"].get_name(): task["json_data_path"]}
+    return {
+        json_data_path: {
+            "dataset_name": task["dataset_name"],
+            "subset_name": task["subset_name"],
+            "prompt_template": task["prompt_template"],
+            "prompt_name": prompt_name,
+            "split": task["split"],
+            "start": task["start"],
+            "end": task["end"],
+            "seed": task["seed"],
+            **task["output_options"],
+        }
+        for prompt_name, json_data_path in json_data_paths.items()
+    }
+
+
+def export_task(task):
+    """
+    Exports the shard of a task planned by plan_tasks
+
+    :return: path of the output file, number of rows written, seconds spent, and whether the shard was already
+        complete, in which case it was not exported again
+    """
+    start_time = time.perf_counter()
+    manifests = get_task_manifests(task)
+    if task["resume"] and all(is_shard_complete(path, manifest) for path, manifest in manifests.items()):
+        num_rows = 0
+        for path in manifests:
+            with open(get_manifest_path(path), encoding="utf-8") as file_ptr:
+                num_rows += json.load(file_ptr)["rows"]
+        return ", ".join(manifests), num_rows, time.perf_counter() - start_time, True
+    if "iterable_split" in task:
+        num_rows = export_split_all_prompts(
+            task["json_data_paths"],
+            task["dataset_name"],
+            task["subset_name"],
+            task["prompt_template"],
+            task["prompts"],
+            task["split"],
+            iter_stream_batches(task["iterable_split"]),
+            seed=task["seed"],
+            manifests={manifest["prompt_name"]: manifest for manifest in manifests.values()},
+            output_options=task["output_options"],
+        )
+        return ", ".join(manifests), sum(num_rows.values()), time.perf_counter() - start_time, False
+
+    dataset_split = open_shared_split(task["shared_split"])
+    if task["start"] > 0 or task["end"] < dataset_split.num_rows:
+        dataset_split = dataset_split.select(range(task["start"], task["end"]))
+    if "json_data_paths" in task:
+        num_rows = export_split_all_prompts(
+            task["json_data_paths"],
+            task["dataset_name"],
+            task["subset_name"],
+            task["prompt_template"],
+            task["prompts"],
+            task["split"],
+            iter_dataset_batches(dataset_split),
+            offset=task["start"],
+            seed=task["seed"],
+            manifests={manifest["prompt_name"]: manifest for manifest in manifests.values()},
+            output_options=task["output_options"],
+        )
+        return ", ".join(manifests), sum(num_rows.values()), time.perf_counter() - start_time, False
+    num_rows = export_split(
+        task["json_data_path"],
+        task["dataset_name"],
+        task["subset_name"],
+        task["prompt_template"],
+        task["prompt"],
+        task["split"],
+        dataset_split,
+        offset=task["start"],
+        seed=task["seed"],
+        manifest=manifests[task["json_data_path"]],
+        output_options=task["output_options"],
+    )
+    return task["json_data_path"], num_rows, time.perf_counter() - start_time, False
+
+
+def run_tasks(executor, tasks, num_workers):
+    """
+    Runs the export tasks on a pool of workers and reports how busy the workers were
+    """
+    start_time = time.perf_counter()
+    busy_time = 0.0
+    total_num_rows = 0
+    num_resumed_tasks = 0
+    futures = [executor.submit(export_task, task) for task in tasks]
+    for future in tqdm(concurrent.futures.as_completed(futures), total=len(futures)):
+        try:
+            json_data_path, num_rows, seconds, resumed = future.result()
+            busy_time += seconds
+            total_num_rows += num_rows
+            num_resumed_tasks += resumed
+            print("{}:: {}!".format("Already completed" if resumed else "Completed", json_data_path))
+        except Exception as emsg:
+            print("Exception msg: {}".format(emsg))
+    wall_time = time.perf_counter() - start_time
+    print(
+        "Exported {} rows in {} tasks ({} already completed) in {:.1f}s, worker utilization {:.0%}".format(
+            total_num_rows, len(tasks), num_resumed_tasks, wall_time, busy_time / max(wall_time * num_workers, 1e-9)
+        )
+    )
+
+
+def project_prompt_dataset(
+    raw_output_dir,
+    dataset_name,
+    subset_name,
+    prompt_template,
+    cache_dir,
+    square_root_num_proc=1,
+    seed=None,
+    shard_size=DEFAULT_SHARD_SIZE,
+    example_major=False,
+    data_files=None,
+    streaming=False,
+    resume=False,
+    output_options=None,
+):
+    job = load_job(raw_output_dir, dataset_name, subset_name, prompt_template, cache_dir, data_files, streaming)
+    tasks = plan_tasks([job], shard_size, seed, example_major, resume, output_options)
     with concurrent.futures.ProcessPoolExecutor(max_workers=square_root_num_proc) as executor:
-        for _out in tqdm(
-            executor.map(
-                export_dataset,
-                [dataset_output_dir for _ in range(total_num_prompts)],
-                [dataset_name for _ in range(total_num_prompts)],
-                [subset_name for _ in range(total_num_prompts)],
-                [prompt_template for _ in range(total_num_prompts)],
-                [prompts[prompt_name] for prompt_name in prompt_names],
-                [dataset for _ in range(total_num_prompts)],
-            ),
-            total=total_num_prompts,
-        ):
-            try:
-                print(_out)
-            except Exception as emsg:
-                print("Exception msg: {}".format(emsg))
+        run_tasks(executor, tasks, square_root_num_proc)
 
 
 def invoke_none(lst):
@@ -144,6 +922,87 @@ def main():
         default=9,
         help="Total number of parallel process will be `--square-root-num-proc * --square-root-num-proc.`",
     )
+    parser.add_argument(
+        "--num-proc",
+        type=int,
+        default=None,
+        help="Number of worker processes, defaults to `--square-root-num-proc * --square-root-num-proc`.",
+    )
+    parser.add_argument(
+        "--shard-size",
+        type=int,
+        default=DEFAULT_SHARD_SIZE,
+        help="Maximum number of examples rendered by a task. Splits with more examples are exported in several "
+        "files named `<prompt>-<shard index>-of-<number of shards>.<extension>`.",
+    )
+    parser.add_argument(
+        "--example-major",
+        action="store_true",
+        help="Render each example with all the prompts of its dataset at once, instead of going over the dataset "
+        "once per prompt. The output files are the same.",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Stream the datasets instead of downloading and preparing them first, so that memory and disk usage do "
+        "not depend on their size. Each split is read once for all the prompts, as with `--example-major`, and is "
+        "not sharded.",
+    )
+    parser.add_argument(
+        "--data-files",
+        nargs="+",
+        default=None,
+        help="Data files of the datasets, e.g. with `--dataset-name-or-paths json`. Each entry is either a path, for "
+        "the train split, or `<split>=<path>`.",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip the shards already exported by a previous run with the same options. Each output file is written "
+        "next to a `<file>.manifest.json` recording its number of rows, size and checksum, and a shard is skipped "
+        "when its files match their manifests.",
+    )
+    parser.add_argument(
+        "--output-format",
+        choices=list(OUTPUT_FORMATS),
+        default="jsonl",
+        help="Format of the output files. `parquet` and `arrow` (Arrow IPC stream, which `datasets.Dataset.from_file` "
+        "memory-maps) files also have the answer choices of the rows, and dictionary-encode their metadata.",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=[compression for compression in COMPRESSIONS if compression is not None],
+        default=None,
+        help="Compress the output files as they are written. `zstd` requires the `zstandard` package for JSONL "
+        "outputs. Parquet outputs support `gzip` and `zstd`, and Arrow outputs `zstd`.",
+    )
+    parser.add_argument(
+        "--serializer",
+        choices=list(SERIALIZERS),
+        default="json",
+        help="Serializer of the rows. `orjson`, available when the `orjson` package is installed, is several times "
+        "faster than the default `json`, and writes non-ASCII characters as is instead of escaping them.",
+    )
+    parser.add_argument(
+        "--max-file-size",
+        type=int,
+        default=None,
+        help="Roll the output files over files named `<file>-part-<index>.<extension>` of about this number of bytes "
+        "once compressed.",
+    )
+    parser.add_argument(
+        "--metadata-header",
+        action="store_true",
+        help="Write the metadata that is the same for all the rows of a file (prompt, dataset, subset and split) "
+        'once, as its first line `{"header": {...}}`, instead of in every row.',
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed of the random choices made by prompts. Each example gets its own random stream derived from the "
+        "seed, the prompt, the split and the example index, so runs are reproducible shard by shard.",
+    )
     args = parser.parse_args()
 
     assert len(args.dataset_name_or_paths) == len(args.dataset_configs)
@@ -153,34 +1012,53 @@ def main():
     invoke_none(args.dataset_configs)
     invoke_none(args.prompt_templates_configs)
 
-    # for (dataset_name_or_path, dataset_config, prompt_template_config) in zip(
-    #     args.dataset_name_or_paths, args.dataset_configs, args.prompt_templates_configs
-    # ):
-    #     project_prompt_dataset(
-    #         args.raw_output_dir,
-    #         dataset_name_or_path,
-    #         dataset_config,
-    #         prompt_template_config,
-    #         cache_dir=args.cache_dir,
-    #         square_root_num_proc=args.square_root_num_proc,
-    #     )
-    with concurrent.futures.ProcessPoolExecutor(max_workers=args.square_root_num_proc) as executor:
-        for _out in tqdm(
-            executor.map(
-                project_prompt_dataset,
-                [args.raw_output_dir for _ in range(len(args.dataset_name_or_paths))],
-                [dataset_name_or_path for dataset_name_or_path in args.dataset_name_or_paths],
-                [dataset_config for dataset_config in args.dataset_configs],
-                [prompt_template_config for prompt_template_config in args.prompt_templates_configs],
-                [args.cache_dir for _ in range(len(args.dataset_name_or_paths))],
-                [args.square_root_num_proc for _ in range(len(args.dataset_name_or_paths))],
-            ),
-            total=len(args.dataset_name_or_paths),
-        ):
+    if args.output_format == "jsonl" and args.compression == "zstd" and zstandard is None:
+        parser.error("--compression zstd requires the zstandard package: pip install zstandard")
+    if args.output_format != "jsonl" and args.compression not in OUTPUT_FORMATS[args.output_format].compressions:
+        parser.error("--compression {} is not supported by {} outputs".format(args.compression, args.output_format))
+
+    data_files = None
+    if args.data_files:
+        data_files = defaultdict(list)
+        for data_file in args.data_files:
+            split, _, path = data_file.rpartition("=")
+            data_files[split or "train"].append(path)
+        data_files = dict(data_files)
+
+    # All the tasks of all the datasets share a single pool of workers, which first loads the datasets
+    num_workers = args.num_proc or args.square_root_num_proc * args.square_root_num_proc
+    with concurrent.futures.ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [
+            executor.submit(
+                load_job,
+                args.raw_output_dir,
+                dataset_name_or_path,
+                dataset_config,
+                prompt_template_config,
+                args.cache_dir,
+                data_files,
+                args.streaming,
+            )
+            for dataset_name_or_path, dataset_config, prompt_template_config in zip(
+                args.dataset_name_or_paths, args.dataset_configs, args.prompt_templates_configs
+            )
+        ]
+        jobs = []
+        for future in futures:
             try:
-                print(_out)
+                jobs.append(future.result())
             except Exception as emsg:
                 print("Exception msg: {}".format(emsg))
+        output_options = {
+            "output_format": args.output_format,
+            "compression": args.compression,
+            "serializer": args.serializer,
+            "max_file_size": args.max_file_size,
+            "metadata_header": args.metadata_header,
+        }
+        tasks = plan_tasks(jobs, args.shard_size, args.seed, args.example_major, args.resume, output_options)
+        run_tasks(executor, tasks, num_workers)
+
 
 if __name__ == "__main__":
     main()
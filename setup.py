@@ -11,7 +11,7 @@ requirements = [
     "pytest",
     "pyyaml>=5",
     "streamlit==0.82",
-    "jinja2",
+    "jinja2>=3.0",
     "plotly",
     "requests",
     "pandas",
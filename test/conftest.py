@@ -0,0 +1,29 @@
+import pytest
+
+import promptsource.templates
+from promptsource.templates import DatasetTemplates, Template
+
+
+@pytest.fixture
+def templates_folder(tmp_path, monkeypatch):
+    """
+    Redirects the templates folder, and the files derived from it, to a temporary directory so that tests can write
+    templates.
+    """
+    monkeypatch.setattr(promptsource.templates, "TEMPLATES_FOLDER_PATH", str(tmp_path / "templates"))
+    monkeypatch.setenv("PROMPTSOURCE_TEMPLATE_ID_INDEX", str(tmp_path / "template_ids.index"))
+    monkeypatch.setenv("PROMPTSOURCE_TEMPLATES_CATALOG", str(tmp_path / "templates_catalog.parquet"))
+    return tmp_path / "templates"
+
+
+@pytest.fixture
+def dummy_templates_folder(templates_folder):
+    """
+    Temporary templates folder with a couple of datasets, see templates_folder.
+    """
+    datasets = [("dummy", None, 2), ("super_dummy", "a", 1), ("super_dummy", "b", 3)]
+    for dataset_name, subset_name, num_templates in datasets:
+        dataset_templates = DatasetTemplates(dataset_name, subset_name)
+        for i in range(num_templates):
+            dataset_templates.add_template(Template(f"template {i}", "{{ text }} ||| {{ label }}", ""))
+    return templates_folder
@@ -0,0 +1,252 @@
+import pytest
+
+import promptsource.templates
+from promptsource.templates import CompiledTemplateCache, DatasetTemplates, Template
+
+
+def test_compiled_template_cache():
+    """
+    Checks that the compiled template cache reuses entries, evicts the least recently used ones and can be
+    invalidated per template.
+    """
+    cache = CompiledTemplateCache(maxsize=2)
+    first = cache.get("{{ a }}", "|||", owner="t1")
+    assert cache.get("{{ a }}", "|||", owner="t1") is first
+    cache.get("{{ b }}", "|||", owner="t2")
+    cache.get("{{ c }}", "|||", owner="t2")
+    assert cache.stats() == {"hits": 1, "misses": 3, "evictions": 1, "size": 2, "maxsize": 2}
+
+    cache.invalidate("t2")
+    assert len(cache) == 0
+
+
+def test_apply_reuses_compiled_template():
+    """
+    Checks that applying a template several times compiles it only once.
+    """
+    template = Template("test", "{{ premise }} ||| {{ answer_choices[label] }}", "", answer_choices="Yes ||| No")
+    misses = promptsource.templates.compiled_templates.misses
+    for label in [0, 1, 0]:
+        template.apply({"premise": "It rains.", "label": label})
+    assert promptsource.templates.compiled_templates.misses == misses + 2
+    assert template.apply({"premise": "It rains.", "label": 1}) == ["It rains.", "No"]
+
+
+def test_update_template_invalidates_cache(templates_folder):
+    """
+    Checks that updating a template drops its compiled versions.
+    """
+    dataset_templates = DatasetTemplates("dummy")
+    template = Template("test", "{{ text }} ||| {{ label }}", "")
+    dataset_templates.add_template(template)
+    assert template.apply({"text": "a", "label": "b"}) == ["a", "b"]
+
+    # Even an edit that keeps the Jinja source compiles the template again
+    dataset_templates.update_template("test", "test", "{{ text }} ||| {{ label }}", "edited", template.metadata, None)
+    misses = promptsource.templates.compiled_templates.stats()["misses"]
+    assert template.apply({"text": "a", "label": "b"}) == ["a", "b"]
+    assert promptsource.templates.compiled_templates.stats()["misses"] == misses + 1
+
+    dataset_templates.update_template("test", "test", "{{ label }} ||| {{ text }}", "", template.metadata, None)
+    assert template.apply({"text": "a", "label": "b"}) == ["b", "a"]
+
+
+def test_apply_batch():
+    """
+    Checks that applying a template to a columnar batch matches applying it row by row, and that rows that fail to
+    render do not abort the batch.
+    """
+    template = Template("test", "{{ premise }} ||| {{ answer_choices[label] }}", "", answer_choices="Yes ||| No")
+    batch = {"premise": ["It rains.", "", "a ||| b"], "label": [0, 1, 1], "unused": ["x", "y", "z"]}
+
+    output = template.apply_batch(batch)
+    assert output["source"] == ["It rains.", None, "a ||| b"]
+    assert output["target"] == ["Yes", None, "No"]
+    assert output["answer_choices"] == [["Yes", "No"], None, ["Yes", "No"]]
+    assert template.apply({"premise": "a ||| b", "label": 1}) == [output["source"][2], output["target"][2]]
+
+
+def test_apply_answer_choices():
+    """
+    Checks that static answer choices follow edits of the template, and that answer choices depending on the example
+    are rendered along with the prompt.
+    """
+    template = Template("test", "{{ premise }} ||| {{ answer_choices[label] }}", "", answer_choices="Yes ||| No")
+    assert template.apply({"premise": "It rains.", "label": 1}) == ["It rains.", "No"]
+    template.answer_choices = "True ||| False"
+    assert template.apply({"premise": "It rains.", "label": 1}) == ["It rains.", "False"]
+
+    template = Template(
+        "test",
+        "{{ premise }} {{ answer_choices | join(' or ') }}? ||| {{ answer_choices[label] }}",
+        "",
+        answer_choices="{{ choice1 }} ||| {{ choice2 }}",
+    )
+    example = {"premise": "It rains.", "choice1": "Wet", "choice2": "Dry", "label": 0}
+    assert template.get_answer_choices_list(example) == ["Wet", "Dry"]
+    assert template.apply(example) == ["It rains. Wet or Dry?", "Wet"]
+    assert template.apply_batch({key: [value] for key, value in example.items()})["answer_choices"] == [["Wet", "Dry"]]
+
+
+def test_referenced_fields():
+    """
+    Checks that the referenced fields cover the prompt and the answer choices, and that other fields are ignored.
+    """
+    template = Template(
+        "test",
+        "{% set prefix = 'Q:' %}{{ prefix }} {{ question }} ||| {{ answer_choices[label] }}",
+        "",
+        answer_choices="{{ options | join('|||') }}",
+    )
+    assert template.referenced_fields == {"question", "label", "options"}
+
+    example = {"question": "Why?", "label": 1, "options": ["a", "b"], "article": "Unused |||" * 1000}
+    assert template.apply(example) == ["Q: Why?", "b"]
+    with pytest.raises(ValueError):
+        template.apply({**example, "answer_choices": []})
+
+
+def test_apply_output_filters():
+    """
+    Checks that the truncate/highlight/no_none options wrap whole output expressions, including ones containing a
+    literal "}}".
+    """
+    template = Template("test", "{{ '}}' ~ text }} ||| {{ label }}", "")
+    example = {"text": "word " * 1000, "label": "yes"}
+    source, target = template.apply(example, truncate=True)
+    assert source.startswith("}}word") and len(source) <= promptsource.templates.TEXT_VAR_LENGTH
+    assert template.apply(example, highlight_variables=True)[1] == "<span style='color: #F08080'>yes</span>"
+    with pytest.raises(ValueError):
+        template.apply({"text": "a", "label": ""})
+    assert template.apply({"text": "a", "label": ""}, no_none=False) == ["}}a", ""]
+
+
+def test_bytecode_cache(tmp_path):
+    """
+    Checks that compiled templates are persisted in, and reused from, the bytecode cache.
+    """
+    promptsource.templates.enable_bytecode_cache(str(tmp_path))
+    try:
+        template = Template("test", "{{ text }} ||| {{ answer_choices[label] }}", "", answer_choices="A ||| B")
+        assert promptsource.templates.precompile_templates([template]) == 1
+        assert len(list(tmp_path.iterdir())) == 2
+
+        promptsource.templates.compiled_templates.invalidate(template.get_id())
+        assert template.apply({"text": "a", "label": 1}) == ["a", "B"]
+        assert len(list(tmp_path.iterdir())) == 2
+    finally:
+        promptsource.templates.disable_bytecode_cache()
+
+
+def test_answer_choices_kind():
+    """
+    Checks the classification of answer choices, and that it follows edits of the template.
+    """
+    template = Template(
+        "test",
+        "{{ premise }} ||| {% if label != -1 %}{{ answer_choices[label] }}{% endif %}",
+        "",
+        answer_choices="Yes ||| No",
+    )
+    assert template.get_answer_choices_kind() == Template.LABEL_INDEXED_ANSWER_CHOICES
+    assert template.get_answer_choices_label_field() == "label"
+    assert template.get_fixed_answer_choices_list() == ["Yes", "No"]
+
+    template.jinja = "{{ premise }} ||| {{ answer_choices[0] if label else answer_choices[1] }}"
+    assert template.get_answer_choices_kind() == Template.STATIC_ANSWER_CHOICES
+    assert template.get_answer_choices_label_field() is None
+
+    template.delimeter = "@@"
+    template.answer_choices = "Yes @@ No @@ Maybe"
+    assert template.get_fixed_answer_choices_list() == ["Yes", "No", "Maybe"]
+
+    template.answer_choices = "{{ choice1 }} @@ {{ choice2 }}"
+    assert template.get_answer_choices_kind() == Template.DYNAMIC_ANSWER_CHOICES
+    assert template.get_fixed_answer_choices_list() is None
+
+    template.answer_choices = None
+    assert template.get_answer_choices_kind() is None
+
+
+def test_apply_seeded_choice():
+    """
+    Checks that random choices only depend on the seed and the position of the example.
+    """
+    template = Template("test", "{{ options | choice }} ||| {{ label }}", "")
+    batch = {"options": [["a", "b", "c", "d"]] * 20, "label": ["x"] * 20}
+    output = template.apply_batch(batch, indices=list(range(100, 120)), seed=42, split="train")
+    assert output == template.apply_batch(batch, indices=list(range(100, 120)), seed=42, split="train")
+    assert len(set(output["source"])) > 1
+
+    rng = promptsource.templates.get_example_rng(42, template.get_id(), "train", 105)
+    assert template.apply({"options": batch["options"][0], "label": "x"}, rng=rng)[0] == output["source"][5]
+
+
+def test_apply_constant_choice():
+    """
+    Checks that choices from constant lists are drawn at each rendering, not once when compiling the template.
+    """
+    template = Template("test", '{{ ["a", "b", "c", "d", "e"] | choice }} ||| x', "")
+    assert len({template.apply({})[0] for _ in range(50)}) > 1
+    template = Template("test", '{% set candidate = ["A", "B", "C", "D"] | choice %}{{ candidate }} ||| x', "")
+    assert len({template.apply({})[0] for _ in range(50)}) > 1
+
+
+def test_apply_truncation_budget():
+    """
+    Checks that a truncation budget is shared between fields, keeping short fields whole.
+    """
+    budget = promptsource.templates.TruncationBudget(50)
+    assert budget.allocate({"a": 5, "b": 100, "c": 30}, 45) == {"a": 5, "c": 20, "b": 20}
+    assert budget.truncate_text("one  two three", 2) == "one  two"
+
+    template = Template("test", "Article: {{ article }} Question: {{ question }} ||| {{ answer }}", "")
+    example = {"article": "word " * 1000, "question": "Why is that?", "answer": "Because.", "id": 3}
+    source, target = template.apply(example, truncate=budget)
+    assert len(source.split()) + len(target.split()) == 50
+    assert source.endswith("Question: Why is that?") and target == "Because."
+
+    output = template.apply_batch({key: [value] for key, value in example.items()}, truncate=budget)
+    assert output["source"] == [source]
+
+    # Output fields are kept whole, and prompt fields keep at least a token
+    template = Template("test", "Article: {{ article }} Summary: ||| {{ highlights }}", "")
+    highlights = "The council approved a budget covering schools roads and parks"
+    example = {"article": "word " * 1000, "highlights": highlights}
+    assert template.apply(example, truncate=promptsource.templates.TruncationBudget(30)) == [
+        "Article: " + "word " * 18 + "Summary:",
+        highlights,
+    ]
+    assert template.apply(example, truncate=promptsource.templates.TruncationBudget(12)) == [
+        "Article: word Summary:",
+        highlights,
+    ]
+    with pytest.raises(ValueError, match="truncation budget of 2"):
+        template.apply(example, truncate=promptsource.templates.TruncationBudget(2))
+
+    lengths = []
+    budget = promptsource.templates.TruncationBudget(50, lambda text: lengths.append(text) or len(text), cache_size=2)
+    assert [budget.measure(text) for text in ["a", "bb", "a", "ccc", "bb"]] == [1, 2, 1, 3, 2]
+    assert lengths == ["a", "bb", "ccc", "bb"]
+
+
+def test_apply_all_templates(templates_folder):
+    """
+    Checks that applying all the templates of a dataset at once matches applying them one by one.
+    """
+    dataset_templates = DatasetTemplates("dummy")
+    with dataset_templates.batch():
+        dataset_templates.add_template(
+            Template("a", "{{ text }} ||| {{ answer_choices[label] }}", "", None, "X ||| Y")
+        )
+        dataset_templates.add_template(Template("b", "{{ text }} {{ [1, 2] | choice }} ||| {{ label }}", ""))
+        dataset_templates.add_template(Template("c", "{{ title }} ||| {{ label }}", ""))
+    batch = {"text": ["a ||| b", "c"], "title": ["", "t"], "label": [1, 0]}
+
+    outputs = dataset_templates.apply_batch(batch, indices=[5, 6], seed=0, split="train")
+    assert list(outputs) == ["a", "b", "c"]
+    for template_name, output in outputs.items():
+        assert output == dataset_templates[template_name].apply_batch(batch, [5, 6], seed=0, split="train")
+    assert outputs["a"]["target"] == ["Y", "X"]
+    assert outputs["c"]["source"] == [None, None]
+    assert list(dataset_templates.apply_batch(batch, ["c"])) == ["c"]
@@ -0,0 +1,343 @@
+import concurrent.futures
+import os
+import queue
+
+import pytest
+
+import promptsource.templates
+from promptsource.templates import DatasetTemplates, Template, TemplateCollection
+
+
+def test_lazy_collection(dummy_templates_folder):
+    """
+    Checks that the collection lists datasets and counts templates without loading them.
+    """
+    template_collection = TemplateCollection()
+    assert sorted(template_collection.keys, key=str) == [("dummy", None), ("super_dummy", "a"), ("super_dummy", "b")]
+    assert template_collection.get_templates_count() == {"dummy": 2, "super_dummy": 4}
+    assert len(template_collection.datasets_templates) == 0
+
+    dataset_templates = template_collection.get_dataset("super_dummy", "b")
+    assert template_collection.get_dataset("super_dummy", "b") is dataset_templates
+    dataset_templates.remove_template("template 0")
+    assert template_collection.get_templates_count() == {"dummy": 2, "super_dummy": 3}
+
+    template_collection.get_dataset("new_dummy")
+    assert len(template_collection) == 4
+
+
+def test_templates_pack(dummy_templates_folder, tmp_path_factory, monkeypatch):
+    """
+    Checks that templates are loaded from the pack, unless their YAML file changed since it was built.
+    """
+    pack_path = str(tmp_path_factory.mktemp("pack") / "templates.pack")
+    monkeypatch.setenv("PROMPTSOURCE_TEMPLATES_PACK", pack_path)
+    promptsource.templates.TemplatesPack.build()
+    assert promptsource.templates.get_templates_pack().is_up_to_date()
+
+    dataset_templates = DatasetTemplates("super_dummy", "b")
+    assert len(dataset_templates) == 3
+    assert all("_referenced_fields_memo" in vars(template) for template in dataset_templates.templates.values())
+    assert dataset_templates["template 1"].apply({"text": "a", "label": "b"}) == ["a", "b"]
+
+    dataset_templates.remove_template("template 1")
+    assert not promptsource.templates.get_templates_pack().is_up_to_date()
+    dataset_templates = DatasetTemplates("super_dummy", "b")
+    assert dataset_templates.all_template_names == ["template 0", "template 2"]
+    assert all("_referenced_fields_memo" not in vars(template) for template in dataset_templates.templates.values())
+
+
+def test_query(dummy_templates_folder):
+    """
+    Checks that queries match the metadata of the templates, and follow their changes.
+    """
+    template_collection = TemplateCollection()
+    assert len(template_collection.query()) == 6
+    assert ("super_dummy", "b") in template_collection
+
+    dataset_templates = template_collection.get_dataset("super_dummy", "b")
+    metadata = Template.Metadata(original_task=True, metrics=["Accuracy"], languages=["en"])
+    dataset_templates.update_template("template 1", "template 1", "{{ text }} ||| {{ label }}", "", metadata, None)
+    template_collection.get_dataset("dummy").add_template(
+        Template("template 2", "{{ text }} ||| {{ answer_choices[label] }}", "", metadata, "Yes ||| No")
+    )
+    results = template_collection.query(language="en", metric="Accuracy", original_task=True)
+    assert [(dataset_name, subset_name, template.name) for dataset_name, subset_name, template in results] == [
+        ("dummy", None, "template 2"),
+        ("super_dummy", "b", "template 1"),
+    ]
+    results = template_collection.query(language="en", answer_choices_kind=Template.LABEL_INDEXED_ANSWER_CHOICES)
+    assert [template.name for _, _, template in results] == ["template 2"]
+    template_id = results[0][2].get_id()
+    assert template_collection.query(template_id=template_id) == results
+
+    template_collection.get_dataset("dummy").remove_template("template 2")
+    assert template_collection.query(template_id=template_id) == []
+    assert len(template_collection.query(has_answer_choices=False)) == 6
+    with pytest.raises(ValueError, match=r"expected some of \['answer_choices_kind', "):
+        template_collection.query(author="me")
+
+
+def test_get_by_id(dummy_templates_folder, monkeypatch):
+    """
+    Checks that templates are found by id from the saved index, which follows changes and detects duplicate ids.
+    """
+    template_ids = {
+        template.get_id(): template.name for template in DatasetTemplates("super_dummy", "b").templates.values()
+    }
+    template_collection = TemplateCollection()
+    template_id, template_name = next(iter(template_ids.items()))
+    assert template_collection.get_by_id(template_id).name == template_name
+    assert list(template_collection.datasets_templates) == [("super_dummy", "b")]
+
+    # Only the modified file is read again by a new collection
+    read_keys = []
+    read_dataset_templates = promptsource.templates._read_dataset_templates
+    monkeypatch.setattr(
+        promptsource.templates,
+        "_read_dataset_templates",
+        lambda key: read_keys.append(key) or read_dataset_templates(key),
+    )
+    DatasetTemplates("dummy").remove_template("template 0")
+    template_collection = TemplateCollection()
+    assert template_collection.get_by_id(template_id).name == template_name
+    assert read_keys == [("dummy", None)]
+
+    dataset_templates = template_collection.get_dataset("super_dummy", "b")
+    jinja = "{{ text }} ||| {{ label }}"
+    dataset_templates.update_template("template 1", "renamed", jinja, "", Template.Metadata(), None)
+    template = Template("new", jinja, "")
+    template_collection.get_dataset("super_dummy", "a").add_template(template)
+    assert template_collection.get_by_id(template.get_id()) is template
+    assert template_collection.get_by_id(dataset_templates["renamed"].get_id()).name == "renamed"
+    removed_id = dataset_templates["template 0"].get_id()
+    dataset_templates.remove_template("template 0")
+    with pytest.raises(KeyError):
+        template_collection.get_by_id(removed_id)
+
+    DatasetTemplates("new_dummy").add_template(template)
+    with pytest.raises(ValueError):
+        TemplateCollection().get_by_id(template.get_id())
+
+
+def test_get_by_id_rollback(dummy_templates_folder):
+    """
+    Checks that the saved index of ids only covers the templates of the files, and not changes that are pending in
+    a batch which is then rolled back.
+    """
+    template_collection = TemplateCollection()
+    dataset_templates = template_collection.get_dataset("dummy")
+    removed_id = dataset_templates["template 0"].get_id()
+    added = Template("added", "{{ text }} ||| {{ label }}", "")
+    with pytest.raises(RuntimeError):
+        with dataset_templates.batch():
+            dataset_templates.remove_template("template 0")
+            dataset_templates.add_template(added)
+            assert template_collection.get_by_id(added.get_id()) is added
+            raise RuntimeError()
+
+    assert template_collection.get_by_id(removed_id).name == "template 0"
+    with pytest.raises(KeyError, match="No template with id"):
+        template_collection.get_by_id(added.get_id())
+    template_collection = TemplateCollection()
+    assert template_collection.get_by_id(removed_id).name == "template 0"
+    with pytest.raises(KeyError, match="No template with id"):
+        template_collection.get_by_id(added.get_id())
+
+
+def test_refresh(dummy_templates_folder):
+    """
+    Checks that refreshing the collection only reloads the datasets whose file changed, and updates the indexes.
+    """
+    template_collection = TemplateCollection()
+    assert len(template_collection.query(name="template 0")) == 3
+    dummy_templates = template_collection.get_dataset("dummy")
+    super_dummy_templates = template_collection.get_dataset("super_dummy", "b")
+    template = super_dummy_templates["template 0"]
+    template.apply({"text": "a", "label": "b"})
+    assert template_collection.refresh() == {"added": [], "removed": [], "modified": []}
+
+    # Edits made by another process
+    os.utime(DatasetTemplates.get_yaml_path("dummy"))
+    other_templates = DatasetTemplates("super_dummy", "b")
+    other_templates.remove_template("template 1")
+    DatasetTemplates("new_dummy").add_template(Template("template 0", "{{ text }} ||| {{ label }}", ""))
+    DatasetTemplates("super_dummy", "a").remove_template("template 0")
+
+    changes = template_collection.refresh()
+    assert changes == {
+        "added": [("new_dummy", None)],
+        "removed": [("super_dummy", "a")],
+        "modified": [("super_dummy", "b")],
+    }
+    assert template_collection.get_dataset("dummy") is dummy_templates
+    assert template_collection.get_dataset("super_dummy", "b").all_template_names == ["template 0", "template 2"]
+    # The compiled versions of the replaced templates are dropped
+    misses = promptsource.templates.compiled_templates.stats()["misses"]
+    template_collection.get_dataset("super_dummy", "b")["template 0"].apply({"text": "a", "label": "b"})
+    assert promptsource.templates.compiled_templates.stats()["misses"] == misses + 1
+    assert [key[:2] for key in template_collection.query(name="template 0")] == [
+        ("dummy", None),
+        ("new_dummy", None),
+        ("super_dummy", "b"),
+    ]
+
+
+def test_watcher(dummy_templates_folder):
+    """
+    Checks that the watcher thread reports changes of the templates folder.
+    """
+    template_collection = TemplateCollection()
+    changes = queue.Queue()
+    template_collection.start_watcher(interval=0.01, callback=changes.put)
+    try:
+        DatasetTemplates("new_dummy").add_template(Template("template 0", "{{ text }} ||| {{ label }}", ""))
+        assert changes.get(timeout=10)["added"] == [("new_dummy", None)]
+    finally:
+        template_collection.stop_watcher()
+    assert ("new_dummy", None) in template_collection
+
+
+def test_templates_catalog(dummy_templates_folder, monkeypatch):
+    """
+    Checks that the templates data frame is read from the catalog, which only reads again the modified files.
+    """
+    data_frame = promptsource.templates.get_templates_data_frame()
+    assert list(data_frame.columns) == promptsource.templates.TEMPLATES_CATALOG_SCHEMA.names
+    assert sorted(data_frame["subset"].fillna("")) == ["", "", "a", "b", "b", "b"]
+
+    read_keys = []
+    read_from_file = DatasetTemplates.read_from_file
+    monkeypatch.setattr(
+        DatasetTemplates,
+        "read_from_file",
+        lambda self: read_keys.append((self.dataset_name, self.subset_name)) or read_from_file(self),
+    )
+    assert promptsource.templates.get_templates_data_frame().equals(data_frame)
+    data_frame = promptsource.templates.get_templates_data_frame(["dataset", "name", "languages"])
+    assert list(data_frame.columns) == ["dataset", "name", "languages"]
+    assert read_keys == []
+
+    DatasetTemplates("super_dummy", "b").remove_template("template 1")
+    read_keys.clear()
+    data_frame = promptsource.templates.get_templates_data_frame(["subset", "name"])
+    assert sorted(data_frame[data_frame["subset"] == "b"]["name"]) == ["template 0", "template 2"]
+    assert len(data_frame) == 5
+    assert read_keys == [("super_dummy", "b")]
+
+
+@pytest.mark.parametrize("use_c_dumper", [False, True])
+def test_batch(dummy_templates_folder, monkeypatch, use_c_dumper):
+    """
+    Checks that the changes made in a batch are written once per file, and are rolled back if the batch fails.
+    """
+    written_keys = []
+    write_to_file = DatasetTemplates.write_to_file
+    monkeypatch.setattr(
+        DatasetTemplates,
+        "write_to_file",
+        lambda self: written_keys.append((self.dataset_name, self.subset_name)) or write_to_file(self),
+    )
+    dataset_templates = DatasetTemplates("new_dummy")
+    with dataset_templates.batch():
+        for i in range(20):
+            dataset_templates.add_template(Template(f"template {i}", "{{ text }} ||| {{ label }}" * 10, ""))
+        dataset_templates.remove_template("template 0")
+        assert written_keys == []
+    assert written_keys == [("new_dummy", None)]
+
+    written_keys.clear()
+    template_collection = TemplateCollection()
+    metadata = Template.Metadata(languages=["fr"])
+    with template_collection.batch(use_c_dumper=use_c_dumper):
+        for dataset_name, subset_name, template in template_collection.query():
+            if dataset_name != "dummy":
+                dataset_templates = template_collection.get_dataset(dataset_name, subset_name)
+                dataset_templates.update_template(template.name, template.name, template.jinja, "", metadata, None)
+        template_collection.get_dataset("dummy").remove_template("template 0")
+        template_collection.get_dataset("dummy").remove_template("template 1")
+        assert written_keys == []
+    assert sorted(written_keys, key=str) == [("new_dummy", None), ("super_dummy", "a"), ("super_dummy", "b")]
+    assert not (dummy_templates_folder / "dummy").exists()
+
+    template_collection = TemplateCollection()
+    assert len(template_collection.query(language="fr")) == 23
+    assert template_collection.get_dataset("new_dummy")["template 1"].jinja == "{{ text }} ||| {{ label }}" * 10
+
+    # A batch that fails is rolled back
+    written_keys.clear()
+    dataset_templates = template_collection.get_dataset("new_dummy")
+    with pytest.raises(RuntimeError):
+        with template_collection.batch():
+            dataset_templates.add_template(Template("added", "{{ text }} ||| {{ label }}", ""))
+            dataset_templates.remove_template("template 1")
+            dataset_templates.update_template("template 2", "renamed", "{{ label }}", "", metadata, None)
+            raise RuntimeError()
+    assert written_keys == []
+    assert dataset_templates.all_template_names == DatasetTemplates("new_dummy").all_template_names
+    assert dataset_templates["template 2"].jinja == "{{ text }} ||| {{ label }}" * 10
+    assert ("new_dummy", None, dataset_templates["template 1"]) in template_collection.query(name="template 1")
+    assert template_collection.query(name="added") == template_collection.query(name="renamed") == []
+
+
+def test_write_conflict(dummy_templates_folder):
+    """
+    Checks that writing templates that were modified by someone else since they were read fails and rolls the change
+    back, and that concurrent writers retrying on conflicts do not lose each other's changes.
+    """
+    dataset_templates = DatasetTemplates("super_dummy", "b")
+    stale_templates = DatasetTemplates("super_dummy", "b")
+    dataset_templates.add_template(Template("new", "{{ text }} ||| {{ label }}", ""))
+    with pytest.raises(promptsource.templates.TemplatesFileConflictError):
+        stale_templates.remove_template("template 0")
+    with pytest.raises(promptsource.templates.TemplatesFileConflictError):
+        stale_templates.remove_template("template 1")
+    assert stale_templates.all_template_names == ["template 0", "template 1", "template 2"]
+    os.utime(DatasetTemplates.get_yaml_path("super_dummy", "b"))
+    dataset_templates.remove_template("template 0")
+    assert DatasetTemplates("super_dummy", "b").all_template_names == ["new", "template 1", "template 2"]
+
+    # Changes that could not be written are rolled back, along with the indexes of the collection
+    template_collection = TemplateCollection()
+    stale_templates = template_collection.get_dataset("super_dummy", "b")
+    template_collection.query()
+    DatasetTemplates("super_dummy", "b").remove_template("new")
+    with pytest.raises(promptsource.templates.TemplatesFileConflictError):
+        stale_templates.add_template(Template("t2", "{{ text }} ||| {{ label }}", ""))
+    with pytest.raises(promptsource.templates.TemplatesFileConflictError):
+        stale_templates.update_template("template 1", "t3", "{{ text }}", "", Template.Metadata(), None)
+    assert stale_templates.all_template_names == ["new", "template 1", "template 2"]
+    assert stale_templates["template 1"].jinja == "{{ text }} ||| {{ label }}"
+    assert template_collection.query(name="t2") == template_collection.query(name="t3") == []
+    assert len(template_collection.query(name="template 1")) == 2
+
+    def add_template(i):
+        while True:
+            dataset_templates = DatasetTemplates("dummy")
+            try:
+                dataset_templates.add_template(Template(f"thread {i}", "{{ text }} ||| {{ label }}", ""))
+                return
+            except promptsource.templates.TemplatesFileConflictError:
+                pass
+
+    with concurrent.futures.ThreadPoolExecutor(8) as executor:
+        list(executor.map(add_template, range(16)))
+    assert len(DatasetTemplates("dummy")) == 18
+    assert os.listdir(dummy_templates_folder / "dummy") == ["templates.yaml"]
+
+
+@pytest.mark.parametrize("use_processes", [False, True])
+def test_load_all(dummy_templates_folder, use_processes):
+    """
+    Checks that all the DatasetTemplates can be loaded concurrently.
+    """
+    template_collection = TemplateCollection()
+    template_collection.get_dataset("dummy")
+    timings = template_collection.load_all(max_workers=2, use_processes=use_processes)
+    assert sorted(timings, key=str) == [("super_dummy", "a"), ("super_dummy", "b")]
+    assert {key: len(value) for key, value in template_collection.datasets_templates.items()} == {
+        ("dummy", None): 2,
+        ("super_dummy", "a"): 1,
+        ("super_dummy", "b"): 3,
+    }
+    assert template_collection.get_dataset("super_dummy", "b")["template 2"].name == "template 2"
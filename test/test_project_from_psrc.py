@@ -0,0 +1,207 @@
+import gzip
+import json
+import lzma
+import os
+import sys
+
+import datasets
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from promptsource.templates import DatasetTemplates
+
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import project_from_psrc  # noqa: E402
+
+
+@pytest.fixture
+def data_files(tmp_path):
+    """
+    Writes a small ag_news-like dataset in local JSON files, which the packaged "json" dataset loads offline.
+    """
+    data_files = {}
+    for split, num_rows in [("train", 30), ("test", 7)]:
+        path = tmp_path / "data" / f"{split}.jsonl"
+        path.parent.mkdir(exist_ok=True)
+        with open(path, "w", encoding="utf-8") as data_file:
+            for i in range(num_rows):
+                data_file.write(json.dumps({"text": f"Nouvelles {i} ||| é", "label": i % 4}) + "\n")
+        data_files[split] = [str(path)]
+    return data_files
+
+
+def export(tmp_path, output_name, data_files, **kwargs):
+    # Exports the local dataset with the ag_news prompts, and returns the output dir of the dataset
+    output_dir = tmp_path / output_name
+    project_from_psrc.project_prompt_dataset(
+        str(output_dir), "json", None, "ag_news", str(tmp_path / "cache"), data_files=data_files, **kwargs
+    )
+    return output_dir / "json"
+
+
+def read_outputs(output_dir, extension=".jsonl"):
+    # Contents of the output files of an export, by path relative to its output dir
+    return {
+        str(path.relative_to(output_dir)): path.read_bytes()
+        for path in sorted(output_dir.rglob("*" + extension))
+        if not path.name.endswith(".manifest.json")
+    }
+
+
+def test_export_modes(tmp_path, data_files):
+    """
+    Checks that all the export modes write the same files, in the row format of the original script.
+    """
+    outputs = read_outputs(export(tmp_path, "default", data_files))
+    assert outputs == read_outputs(export(tmp_path, "example_major", data_files, example_major=True))
+    assert outputs == read_outputs(export(tmp_path, "streaming", data_files, streaming=True))
+
+    prompts = DatasetTemplates("ag_news")
+    assert len(outputs) == 2 * len(prompts)
+    with open(data_files["test"][0], encoding="utf-8") as data_file:
+        examples = [json.loads(line) for line in data_file]
+    for prompt_name in prompts.all_template_names:
+        expected_lines = []
+        for _id, example in enumerate(examples):
+            source, target = prompts[prompt_name].apply(example)
+            row = {
+                "id": _id,
+                "source": source,
+                "target": target,
+                "prompt_template": "ag_news",
+                "prompt_name": prompt_name,
+                "dataset_name": "json",
+                "subset_name": None,
+                "split": "test",
+            }
+            expected_lines.append(json.dumps(row) + "\n")
+        file_name = os.path.join("test", "ag_news." + prompt_name.replace(" ", "_") + ".jsonl")
+        assert outputs[file_name].decode("utf-8") == "".join(expected_lines)
+
+
+def test_iter_stream_batches():
+    """
+    Checks that streamed rows are grouped in columnar batches until the end of the split, and that errors while
+    reading the split are raised to the consumer.
+    """
+    rows = [{"text": str(i), "label": i} for i in range(2500)]
+    batches = list(project_from_psrc.iter_stream_batches(rows, buffer_size=1))
+    assert [len(batch["text"]) for batch in batches] == [1000, 1000, 500]
+    assert sum((batch["label"] for batch in batches), []) == list(range(2500))
+
+    def failing_rows():
+        yield from rows
+        raise OSError("Connection lost")
+
+    batches = project_from_psrc.iter_stream_batches(failing_rows(), buffer_size=1)
+    assert len(next(batches)["text"]) == 1000
+    with pytest.raises(OSError, match="Connection lost"):
+        list(batches)
+
+
+def test_resume(tmp_path, data_files):
+    """
+    Checks that resuming an export only exports again the shards whose files do not match their manifests.
+    """
+    output_dir = export(tmp_path, "output", data_files, shard_size=12)
+    outputs = read_outputs(output_dir)
+    assert "train/ag_news.classify-00002-of-00003.jsonl" in outputs
+    stats = {path: (output_dir / path).stat().st_mtime_ns for path in outputs}
+
+    truncated_path = output_dir / "train" / "ag_news.classify-00001-of-00003.jsonl"
+    truncated_path.write_bytes(outputs["train/ag_news.classify-00001-of-00003.jsonl"][:-10])
+    removed_path = output_dir / "test" / "ag_news.recommend.jsonl"
+    removed_path.unlink()
+    export(tmp_path, "output", data_files, shard_size=12, resume=True)
+
+    assert read_outputs(output_dir) == outputs
+    skipped_paths = {path for path, mtime in stats.items() if (output_dir / path).stat().st_mtime_ns == mtime}
+    assert sorted(set(outputs) - skipped_paths) == [
+        "test/ag_news.recommend.jsonl",
+        "train/ag_news.classify-00001-of-00003.jsonl",
+    ]
+    with open(project_from_psrc.get_manifest_path(str(truncated_path)), encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+    assert (manifest["start"], manifest["end"], manifest["rows"]) == (10, 20, 10)
+
+
+@pytest.mark.parametrize("compression,open_file", [("gzip", gzip.open), ("xz", lzma.open)])
+def test_compressed_outputs(tmp_path, data_files, compression, open_file):
+    """
+    Checks that compressed output files decompress to the uncompressed ones.
+    """
+    outputs = read_outputs(export(tmp_path, "default", data_files))
+    output_dir = export(tmp_path, compression, data_files, output_options={"compression": compression})
+    extension = project_from_psrc.COMPRESSIONS[compression][0]
+    compressed_paths = sorted(output_dir.rglob("*.jsonl" + extension))
+    assert len(compressed_paths) == len(outputs)
+    for path in compressed_paths:
+        with open_file(path, "rb") as compressed_file:
+            assert compressed_file.read() == outputs[str(path.relative_to(output_dir))[: -len(extension)]]
+
+
+def test_rolled_outputs(tmp_path, data_files):
+    """
+    Checks that outputs rolled over several files have the same rows, and that exporting them again over fewer files
+    removes the previous files.
+    """
+    outputs = read_outputs(export(tmp_path, "default", data_files))
+    output_dir = export(tmp_path, "rolled", data_files, output_options={"max_file_size": 1000})
+    part_paths = sorted((output_dir / "train").glob("ag_news.classify-part-*.jsonl"))
+    assert len(part_paths) > 2
+    assert b"".join(path.read_bytes() for path in part_paths) == outputs["train/ag_news.classify.jsonl"]
+    with open(output_dir / "train" / "ag_news.classify.jsonl.manifest.json", encoding="utf-8") as manifest_file:
+        manifest = json.load(manifest_file)
+    assert [written_file["path"] for written_file in manifest["files"]] == [path.name for path in part_paths]
+    assert sum(written_file["rows"] for written_file in manifest["files"]) == manifest["rows"] == 30
+
+    export(tmp_path, "rolled", data_files, output_options={"max_file_size": 4000})
+    part_paths = sorted((output_dir / "train").glob("ag_news.classify-part-*.jsonl"))
+    assert b"".join(path.read_bytes() for path in part_paths) == outputs["train/ag_news.classify.jsonl"]
+    export(tmp_path, "rolled", data_files)
+    assert read_outputs(output_dir) == outputs
+
+
+def test_metadata_header(tmp_path, data_files):
+    """
+    Checks that rows written with a metadata header, and another serializer, have the same content.
+    """
+    outputs = read_outputs(export(tmp_path, "default", data_files))
+    output_options = {"metadata_header": True, "serializer": "orjson" if project_from_psrc.orjson else "json"}
+    header_outputs = read_outputs(export(tmp_path, "header", data_files, output_options=output_options))
+    assert header_outputs.keys() == outputs.keys()
+    for path, output in header_outputs.items():
+        header, *rows = [json.loads(line) for line in output.decode("utf-8").splitlines()]
+        expected_rows = [json.loads(line) for line in outputs[path].decode("utf-8").splitlines()]
+        assert [{**row, **header["header"]} for row in rows] == expected_rows
+
+
+@pytest.mark.parametrize("output_format", ["parquet", "arrow"])
+def test_columnar_outputs(tmp_path, data_files, output_format):
+    """
+    Checks that Parquet and Arrow outputs have the rows of JSONL outputs, along with their answer choices, and
+    dictionary-encode their metadata.
+    """
+    outputs = read_outputs(export(tmp_path, "default", data_files))
+    output_options = {"output_format": output_format, "compression": "zstd"}
+    output_dir = export(tmp_path, output_format, data_files, output_options=output_options)
+    columnar_outputs = read_outputs(output_dir, "." + output_format)
+    assert len(columnar_outputs) == len(outputs)
+
+    prompts = DatasetTemplates("ag_news")
+    for path, output in outputs.items():
+        columnar_path = output_dir / (path[: -len(".jsonl")] + "." + output_format)
+        rows = [json.loads(line) for line in output.decode("utf-8").splitlines()]
+        if output_format == "parquet":
+            table = pq.read_table(columnar_path)
+        else:
+            table = pa.ipc.open_stream(pa.memory_map(str(columnar_path))).read_all()
+            # The datasets library memory-maps the file, decoding the dictionaries
+            dataset = datasets.Dataset.from_file(str(columnar_path))
+            assert dataset.remove_columns("answer_choices").to_list() == rows
+        assert table.schema == project_from_psrc.PROMPTED_ROW_SCHEMA
+        assert table.drop(["answer_choices"]).to_pylist() == rows
+        prompt = prompts[rows[0]["prompt_name"]]
+        assert table.column("answer_choices").to_pylist() == [prompt.get_fixed_answer_choices_list()] * len(rows)
@@ -10,31 +10,24 @@ env = promptsource.templates.env
 
 # Loads templates and iterates over each data (sub)set
 template_collection = promptsource.templates.TemplateCollection()
+template_collection.load_all()
 
 
-def test_uuids():
+def test_uuids(tmp_path, monkeypatch):
     """
     Checks that all UUIDs across promptsource are unique. (Although collisions
     are unlikely, copying and pasting YAML files could lead to duplicates.
+    Duplicates raise an error when the index of TemplateCollection.get_by_id is built.)
     """
-    all_uuids = {}
-
+    # Builds the index from scratch, without touching the one of the user
+    monkeypatch.setenv("PROMPTSOURCE_TEMPLATE_ID_INDEX", str(tmp_path / "template_ids.index"))
     # Iterates over all datasets
     for dataset_name, subset_name in template_collection.keys:
 
         # Iterates over each template for current data (sub)set
         dataset_templates = template_collection.get_dataset(dataset_name, subset_name)
-        for template_name in dataset_templates.all_template_names:
-            template = dataset_templates[template_name]
-
-            uuid = template.get_id()
-
-            if uuid in all_uuids:
-                raise ValueError(f"Template {template_name} for dataset {dataset_name}/{subset_name} "
-                                 f"has duplicate uuid {template.get_id()} as "
-                                 f"{all_uuids[uuid][0]}/{all_uuids[uuid][1]}.")
-
-            all_uuids[uuid] = (dataset_name, subset_name)
+        for template in dataset_templates.templates.values():
+            assert template_collection.get_by_id(template.get_id()) is template
 
 
 @pytest.mark.parametrize("dataset", template_collection.keys)